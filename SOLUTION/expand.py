@@ -1,16 +1,41 @@
 #!/usr/bin/env python3
 
-import argparse
+##
+## The JIT expander: `jit.sh` runs it once per stubbed command (unless there's
+## an expansion server), so its startup is on the critical path. It only
+## imports what expanding a pickled stub needs; `libdash` (which `utils`
+## imports when parsing) and `argparse` (only for anything other than the
+## JIT's own call) come in when they're used. `bench/startup.py` checks this
+## against an import-time budget.
+##
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from copy import deepcopy
+import functools
+import hashlib
+import mmap
 import os
 import re
 import shlex
 import sys
+import threading
+import time
+
+# before importing (and initializing) everything else, for tracing
+STARTED_US = time.time_ns() // 1000
 
+import utils
 from utils import *  # type: ignore
 from shasta import ast_node as AST
 import sh_expand.expand as expand
-from sh_expand.env_vars_util import read_vars_file
+from sh_expand.env_vars_util import (
+    ansi_c_expand,
+    is_array_variable,
+    parse_array_variable,
+    read_vars_file,
+    set_special_parameters,
+)
 
 def string_of_expanded_arg(arg: list[AST.ArgChar]):
     """
@@ -42,6 +67,9 @@ def command_prepender(exp_state: expand.ExpansionState, unsafe_commands=None):
                     #
                     # Only fill in this part once you have the rest of the JIT working.
                     #
+                    if contains_node(node, AST.BArgChar): # REMOVE
+                        # don't even start: expansion would get partway through the command before failing # REMOVE
+                        raise expand.ImpureExpansion("command substitution") # REMOVE
                     expand.expand_command(node, exp_state) # REPLACE pass # FILL IN OPTIMIZATION HERE
 # REMOVE
                     cmd_name = string_of_expanded_arg(node.arguments[0]) # REMOVE
@@ -70,35 +98,540 @@ def command_prepender(exp_state: expand.ExpansionState, unsafe_commands=None):
 
 
 def prepend_try_to_commands(ast: list[Parsed], exp_state: expand.ExpansionState, unsafe_commands=None):
-    return walk_ast(
-        ast,
-        replace=command_prepender(exp_state, unsafe_commands=unsafe_commands),
+    prepend, tried = recording_tries(command_prepender(exp_state, unsafe_commands=unsafe_commands))
+    return coalesce_tries(walk_ast(ast, replace={AST.CommandNode: prepend}), tried)
+
+
+##
+## Coalescing tries
+##
+## Every command we prepend `try` to gets a sandbox of its own, and its own
+## review of the changes. When a stub runs several in a row (a region, see
+## `--regions` in `solution.py`, or a line of `expand.py --stream`), one `try`
+## can run them all: `try` runs its arguments as a script, so `try rm a; try rm b`
+## becomes `try rm a ";" rm b`. The words are expanded out here, all before
+## `try` runs, so only commands whose words are the same whenever they're
+## expanded get merged: a command substitution, parameter or arithmetic in a
+## later command would see (or, behind a failed `&&`, run) what it shouldn't.
+## The script's status is the status of the commands it ran.
+##
+## Only commands we prepended `try` to get merged, and only those without
+## redirections or assignments (those apply to `try` itself, out here). A run
+## can be a `;` chain, `&&` and `||` lists, or whole pipelines: a pipeline
+## where we left a stage outside the sandbox stays as it is. The shell `try`
+## starts parses the words again, so lists inside lists of another operator
+## go in braces. Under `set -e`, a list ending in `&&` or `||` keeps its
+## `try`s: a command failing before its last `&&` or `||` doesn't exit, but a
+## `try` failing because of it would. `bench/coalesce_tries.py` checks all this.
+##
+
+TRY_OPERATORS = {AST.SemiNode: ";", AST.AndNode: "&&", AST.OrNode: "||", AST.PipeNode: "|"}
+
+# the script `try` runs is a new shell, so it takes on our `set -e` (for a
+# `;` chain) and `pipefail` (for a pipeline) first
+TRY_PRELUDES = {
+    ";": ["case", [AST.QArgChar([AST.VArgChar("Normal", False, "-", [])])], "in", "*e*)", "set", "-e", ";;", "esac", ";"],
+    "|": [
+        "case",
+        [AST.QArgChar(string_to_argchars(":") + [AST.VArgChar("Normal", False, "SHELLOPTS", [])] + string_to_argchars(":"))],
+        "in", "*:pipefail:*)", "set", "-o", "pipefail", ";;", "esac", ";",
+    ],
+}
+
+
+def recording_tries(prepend):
+    """
+    Wraps a `command_prepender`, to also remember the commands it prepended `try` to.
+
+    :return: The wrapped replacer, and the set of the ids of the commands it returned
+    """
+    tried = set()
+
+    def replace(node):
+        new = prepend(node)
+        if new is not None:
+            tried.add(id(new))
+        return new
+
+    return replace, tried
+
+
+def script_word(text: str) -> list[AST.ArgChar]:
+    """
+    A word that reaches `try` as `text`, whatever the shell would make of it.
+    """
+    if re.fullmatch(r"[\w-]+", text):
+        return string_to_argchars(text)
+    return [AST.QArgChar(string_to_argchars(text))]
+
+
+def is_static(word: list[AST.ArgChar]) -> bool:
+    """
+    Whether `word` expands to the same thing whenever it's expanded: no
+    command substitutions, parameters, arithmetic or tildes.
+    """
+    return all(
+        isinstance(c, (AST.CArgChar, AST.EArgChar, LArgChar)) or (isinstance(c, AST.QArgChar) and is_static(c.arg))
+        for c in word
     )
 
 
+def try_script(node, tried: set[int]) -> tuple[list, set[str]] | None:
+    """
+    The words of a script for `try` that runs `node`, and the operators it
+    uses, or `None` if `node` isn't made up of commands we prepended `try` to
+    (with static words, see `is_static`).
+    """
+    match node:
+        case AST.CommandNode() if (
+            id(node) in tried and not node.assignments and not node.redir_list and all(map(is_static, node.arguments))
+        ):
+            return node.arguments[1:], set()
+        case AST.SemiNode() | AST.AndNode() | AST.OrNode():
+            operands = [node.left_operand, node.right_operand]
+        case AST.PipeNode() if not node.is_background:
+            operands = node.items
+        case _:
+            return None
+
+    operator = TRY_OPERATORS[type(node)]
+    words, operators = [], {operator}
+    for operand in operands:
+        script = try_script(operand, tried)
+        if script is None:
+            return None
+        if words:
+            words.append(script_word(operator))
+        words += operand_words(operand, script[0], operator)
+        operators |= script[1]
+    return words, operators
+
+
+def operand_words(operand, words: list, operator: str) -> list:
+    """
+    The script for `operand` of an `operator` list, in braces if `operand` is
+    a list of another operator: the shell `try` starts parses the words with
+    its own precedence, and `a && { b; c; }` isn't `a && b; c`.
+    """
+    if isinstance(operand, AST.CommandNode) or TRY_OPERATORS[type(operand)] == operator:
+        return words
+    return [script_word("{")] + words + [script_word(";"), script_word("}")]
+
+
+def ends_in_list(node) -> bool:
+    """
+    Whether the status of `node` can be that of a command before the last
+    `&&` or `||` of a list, which `set -e` doesn't exit on.
+    """
+    while isinstance(node, AST.SemiNode):
+        node = node.right_operand
+    return isinstance(node, (AST.AndNode, AST.OrNode))
+
+
+def merged_try(node, words: list, operators: set[str]) -> AST.AstNode:
+    """
+    A single `try` running the `words` of the commands in `node`.
+    """
+    prelude = [
+        word if isinstance(word, list) else script_word(word)
+        for operator in sorted(operators)
+        for word in TRY_PRELUDES.get(operator, [])
+    ]
+    line_number = first_line_number(node)
+    merged = AST.CommandNode(
+        arguments=[string_to_argchars("try")] + prelude + words,
+        assignments=[],
+        redir_list=[],
+        line_number=line_number,
+    )
+    if not ends_in_list(node):
+        return merged
+
+    # under `set -e`, `try a "&&" b` failing because `a` did would exit, but
+    # `a && b` doesn't: then the commands keep their own `try`s
+    errexit = AST.CommandNode(
+        arguments=[string_to_argchars(word) for word in ("[", "-o", "errexit", "]")],
+        assignments=[],
+        redir_list=[],
+        line_number=line_number,
+    )
+    return AST.IfNode(errexit, node, merged)
+
+
+def semi_operands(node: AST.SemiNode) -> list:
+    """
+    The commands of a `;` chain, in order, however it's nested.
+    """
+    operands, stack = [], [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, AST.SemiNode):
+            stack += [node.right_operand, node.left_operand]
+        else:
+            operands.append(node)
+    return operands
+
+
+def coalesce_tries(ast: list[AST.AstNode], tried: set[int]) -> list[AST.AstNode]:
+    """
+    Merges runs of adjacent commands we prepended `try` to into a single `try`.
+
+    :param ast: The nodes `prepend_try_to_commands` returned
+    :param tried: The ids of the commands we prepended `try` to, from `recording_tries`
+    """
+    def replace_list(node):
+        script = try_script(node, tried)
+        if script is None or isinstance(node, AST.CommandNode):
+            return None
+        return merged_try(node, *script)
+
+    def replace_semi(node):
+        # `a; b; c` nests either way, but any run of its commands can go together
+        operands, run = [], []
+
+        def flush():
+            if len(run) > 1:
+                words, operators = [], {";"}
+                for operand, script in run:
+                    if words:
+                        words.append(script_word(";"))
+                    words += operand_words(operand, script[0], ";")
+                    operators |= script[1]
+                original = functools.reduce(
+                    lambda left, right: AST.SemiNode(left, right, node.semicolon), [operand for operand, _ in run]
+                )
+                operands.append(merged_try(original, words, operators))
+            elif run:
+                operands.append(replace_list(run[0][0]) or run[0][0])
+            run.clear()
+
+        for operand in semi_operands(node):
+            script = try_script(operand, tried)
+            if script is not None:
+                run.append((operand, script))
+                continue
+            flush()
+            operands.append(walk_ast_node(operand, replace=table))
+        flush()
+        return functools.reduce(lambda left, right: AST.SemiNode(left, right, node.semicolon), operands)
+
+    table = handler_table(
+        {
+            AST.SemiNode: replace_semi,
+            AST.AndNode: replace_list,
+            AST.OrNode: replace_list,
+            AST.PipeNode: replace_list,
+        }
+    )
+    return [walk_ast_node(node, replace=table) for node in ast]
+
+
+def parse_bash_version(bash_version: str) -> tuple[int, int, int]:
+    m = re.match(r"(\d+)\.(\d+)\.(\d+)", bash_version)
+    assert m is not None, f"must be running in bash (BASH_VERSION={bash_version})"
+    return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+
+
+##
+## Reading the shell state
+##
+## `jit.sh` saves the state with `declare -p`, and `read_vars_file` decodes
+## every variable in it, while a stub only reads a handful (and without
+## `JIT_VARS`, the dump holds everything). From bash 5.2 on, `declare -p`
+## escapes newlines, so each variable is a line of its own: a `ShellState` maps
+## the dump, finds where each variable's line starts in one pass, and only
+## decodes the ones that get looked up.
+##
+
+# `declare FLAGS NAME[=VALUE]`, split on spaces the way `read_vars_file` does
+DECLARE_LINE = re.compile(rb"^[^ \n]* [^ \n]* ([^=\n]*)", re.MULTILINE)
+
+# `read_vars_file` sets special parameters (`$@`, `$?`, ...) from these
+SPECIAL_PARAMETER_SOURCES = (
+    "pash_input_args",
+    "pash_previous_exit_status",
+    "pash_previous_set_status",
+    "pash_shell_name",
+)
+
+
+def decode_declare_line(line: str) -> tuple[str, tuple]:
+    """
+    Decodes a line of `declare -p` output (without its newline) just as
+    `read_vars_file` does for bash 5.2 and later.
+
+    :return: The variable's name, and its `(type, value)`
+    """
+    _, var_type, rest = line.split(" ", maxsplit=2)
+    if is_array_variable(var_type):
+        var_name, var_type, val, _ = parse_array_variable(shlex.split(line), 0)
+    else:
+        if var_type == "--":
+            var_type = None
+        if "=" in rest:
+            var_name, val = rest.split("=", maxsplit=1)
+            if val[0:2] == "$'":
+                val = ansi_c_expand(val[1:])
+            val = val[1:-1]
+        else:
+            # declared but unset
+            var_name, val = rest, ""
+    return var_name, (var_type, val)
+
+
+class ShellState(MutableMapping):
+    """
+    The variables in a `declare -p` dump from bash 5.2 or later: the same
+    mapping `read_vars_file` gives, but each variable is only decoded when
+    it's looked up. Assigning to it (e.g., `invalidate_variable`) doesn't
+    touch the dump.
+    """
+
+    def __init__(self, env_path: str):
+        with open(env_path, "rb") as env_file:
+            size = os.fstat(env_file.fileno()).st_size
+            # (an empty file can't be mapped)
+            self.data = mmap.mmap(env_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        # name -> where its line starts (the last one wins, as in `read_vars_file`)
+        self.offsets = {
+            match.group(1).decode("utf-8", errors="replace"): match.start()
+            for match in DECLARE_LINE.finditer(self.data)
+        }
+        # name -> (type, value), once decoded or assigned
+        self.values = {}
+
+        if size and self.data[-1:] != b"\n":
+            # `read_vars_file` drops the last character of every line, newline or not
+            start = self.data.rfind(b"\n") + 1
+            self.offsets = {name: offset for name, offset in self.offsets.items() if offset != start}
+            name, value = self.decode(start)
+            self.values[name] = value
+
+        if any(name in self for name in SPECIAL_PARAMETER_SOURCES):
+            sources = {name: self[name] for name in SPECIAL_PARAMETER_SOURCES if name in self}
+            for name, value in set_special_parameters(sources).items():
+                if name not in sources:
+                    self.values[name] = value
+
+    def decode(self, start: int) -> tuple[str, tuple]:
+        end = self.data.find(b"\n", start)
+        line = self.data[start : end + 1 if end != -1 else len(self.data)]
+        return decode_declare_line(line[:-1].decode("utf-8", errors="replace"))
+
+    def __getitem__(self, name: str) -> tuple:
+        value = self.values.get(name)
+        if value is None:
+            _, value = self.decode(self.offsets[name])
+            self.values[name] = value
+        return value
+
+    def __setitem__(self, name: str, value):
+        self.values[name] = value
+
+    def __delitem__(self, name: str):
+        found = self.offsets.pop(name, None) is not None
+        found = self.values.pop(name, None) is not None or found
+        if not found:
+            raise KeyError(name)
+
+    def __contains__(self, name) -> bool:
+        return name in self.values or name in self.offsets
+
+    def __iter__(self):
+        yield from self.offsets
+        yield from (name for name in self.values if name not in self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) + sum(name not in self.offsets for name in self.values)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def load_variables(env_path: str, bash_version: str) -> MutableMapping:
+    """
+    Loads the shell state saved by `jit.sh`.
+
+    :param env_path: The `declare -p` dump of the shell state
+    :param bash_version: The `$BASH_VERSION` of the shell that saved the state
+    """
+    version = parse_bash_version(bash_version)
+    with trace_span("read_vars_file"):
+        if version >= (5, 2, 0):
+            return ShellState(env_path)
+        # older versions print newlines as they are, so it takes a real lexer
+        variables = read_vars_file(env_path, version)
+    assert variables is not None, "could not parse environment variables"
+    return variables
+
+
+def expand_stub(ast: list[Parsed], variables: dict) -> str:
+    """
+    Expands a parsed stub against the shell state saved by `jit.sh`.
+
+    :param ast: The parsed stub (expansion mutates it!)
+    :param variables: The shell state, from `load_variables`
+    :return: The expanded script, ready to be sourced
+    """
+    exp_state = expand.ExpansionState(variables)
+    for node, _, _, _ in ast:
+        # a region (see `--regions` in `solution.py`) may run a command after one that
+        # assigns a variable it reads, so forget what it assigns, as `expand_stream` does
+        if not isinstance(node, AST.CommandNode):
+            for name in assigned_variables(node):
+                expand.invalidate_variable(name, "assigned in the region", exp_state)
+
+    # Transformations on the expanded AST
+    with trace_span("expand_command"):
+        transformed_ast = prepend_try_to_commands(ast, exp_state, unsafe_commands=["rm"])
+
+    with trace_span("unparse"):
+        return ast_to_code(transformed_ast)
+
+
+##
+## Caching expansions
+##
+## A stub inside a loop gets expanded over and over, usually with the same
+## values for the handful of variables it reads. The outcome of expansion
+## (including whether we gave up and prepended `try`) only depends on the stub
+## and those values, so we can remember the expanded script.
+##
+
+class ExpansionCache:
+    """
+    A size-bounded LRU cache of expanded stubs, keyed by the stub and a hash
+    of the values of the variables it reads.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # the expansion server looks things up from several threads
+        self.lock = threading.Lock()
+
+    def key(self, stub_key, stub: Stub, variables: dict):
+        """
+        :return: The cache key, or `None` if we don't know which variables the stub reads
+        """
+        if stub.variables is None:
+            return None
+
+        names = sorted(stub.variables | IMPLICIT_VARIABLES)
+        values = repr([(name, variables.get(name)) for name in names])
+        return (stub_key, hashlib.sha256(values.encode("utf-8")).digest())
+
+    def get(self, key) -> str | None:
+        with self.lock:
+            expanded = self.entries.get(key)
+            if expanded is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return expanded
+
+    def put(self, key, expanded: str):
+        with self.lock:
+            self.entries[key] = expanded
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __repr__(self):
+        return f"ExpansionCache: {len(self.entries)} entries, {self.hits} hits, {self.misses} misses"
+
+
+def expand_stream(input_script: str, variables: dict, output: str):
+    """
+    Expands a whole script against one shell state, one top-level command
+    at a time, writing each out before parsing the next.
+
+    Variables the script assigns (by plain assignments, `${x=...}` or `for`)
+    aren't expanded from the command that assigns them on. Other ways of
+    changing the state (`read`, `eval`, functions...) aren't tracked, just as
+    when expanding a stub of several commands.
+
+    :param input_script: The script to expand (`-` for stdin)
+    :param variables: The shell state, from `load_variables`
+    :param output: Where to write the expanded script (`-` for stdout)
+    """
+    exp_state = expand.ExpansionState(variables)
+    prepend, tried = recording_tries(command_prepender(exp_state, unsafe_commands=["rm"]))
+    replace = handler_table({AST.CommandNode: prepend})
+    with open_output(output) as out_file:
+        for node, _, _, _ in parse_shell_to_asts(input_script):
+            # the saved state doesn't know what the script assigns (here, or in
+            # an earlier command), so commands reading those variables can't be expanded
+            for name in assigned_variables(node):
+                expand.invalidate_variable(name, "assigned by the script", exp_state)
+            [node] = coalesce_tries([walk_ast_node(node, replace=replace)], tried)
+            tried.clear()
+            print(node.pretty(), file=out_file)
+
+
+def expand_stub_main(bundle: str, stub_id: int, bash_version: str, env_path: str | None = None):
+    """
+    Prints stub `stub_id` of `bundle`, expanded against the state `jit.sh` saved.
+
+    :param env_path: Where `jit.sh` saved the state (by default, `BUNDLE.STUB_ID.env`)
+    """
+    # our spans go in the `jit.sh` span that ran us
+    utils.TRACE_PID = os.getppid()
+    with trace_span("expand.py", STARTED_US, stub=stub_id) as span:
+        if TRACE_PATH:
+            trace_event("imports", STARTED_US, time.time_ns() // 1000)
+
+        # load the pickled stub
+        with trace_span("load_stub"):
+            ast = load_stub(bundle, stub_id)
+        span["line"] = ast[0][2]
+        variables = load_variables(env_path or f"{bundle}.{stub_id}.env", bash_version)
+
+        print(expand_stub(ast, variables))
+
+
 def main():
+    # the JIT's own call (`expand.py BUNDLE STUB_ID BASH_VERSION ENV`) doesn't
+    # need argparse, which takes about as long to import as everything else
+    argv = sys.argv[1:]
+    if len(argv) in (3, 4) and not argv[0].startswith("-") and argv[1].isdigit():
+        expand_stub_main(argv[0], int(argv[1]), *argv[2:])
+        return
+
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Expand a shell script using sh-expand"
     )
-    parser.add_argument("input_script", help="Path to the input shell script")
+    parser.add_argument("bundle", nargs="?", help="Path to the stub bundle")
+    parser.add_argument("stub_id", type=int, nargs="?", help="The id of the stub in the bundle")
     parser.add_argument("bash_version", help="The version of bash used to capture the environment in the JIT")
+    parser.add_argument(
+        "env_path", nargs="?", help="The `declare -p` dump of the stub's state (by default, BUNDLE.STUB_ID.env)"
+    )
+    parser.add_argument(
+        "--stream",
+        metavar="SCRIPT",
+        help="Instead of a stub, expand SCRIPT (`-` for stdin) one command at a time",
+    )
+    parser.add_argument("--env", help="With `--stream`, the `declare -p` dump to expand against")
+    parser.add_argument("--output", "-o", default="-", help="With `--stream`, where to write the expanded script")
     args = parser.parse_args()
 
-    # reparse the stub
-    # if we had pickled the AST, we could just unpickle it here
-    ast = list(parse_shell_to_asts(args.input_script))
+    if args.stream:
+        variables = load_variables(args.env, args.bash_version) if args.env else {}
+        expand_stream(args.stream, variables, args.output)
+        return
+    if args.bundle is None or args.stub_id is None:
+        parser.error("need a bundle and a stub id (or `--stream`)")
 
-    # load the environment
-    m = re.match(r"(\d+)\.(\d+)\.(\d+)", args.bash_version)
-    assert m is not None, f"must be running in bash (BASH_VERSION={args.bash_version})"
-    variables = read_vars_file(args.input_script + ".env", (int(m.group(1)), int(m.group(2)), int(m.group(3))))
-    assert variables is not None, "could not parse environment variables"
-    exp_state = expand.ExpansionState(variables)
-
-    # Transformations on the expanded AST
-    transformed_ast = prepend_try_to_commands(ast, exp_state, unsafe_commands=["rm"])
+    expand_stub_main(args.bundle, args.stub_id, args.bash_version, args.env_path)
 
-    print(ast_to_code(transformed_ast))
 
 if __name__ == "__main__":
     main()
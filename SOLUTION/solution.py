@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections.abc import Iterator
-import itertools
+from collections.abc import Iterable, Iterator
+import functools
 import sys
 import os
+import re
+import shutil
+import tempfile
+from typing import NamedTuple
 
 from utils import *  # type: ignore
 from shasta import ast_node as AST
@@ -49,15 +53,19 @@ def step1_parse_script(input_script):
 
 ##
 ## Step 2:
-##   Use our `walk_ast` visitor to print out every AST node.
+##   Use our `iter_ast` traversal to print out every AST node.
+##
+##   (`walk_ast` can visit every node too, but it's built for replacing nodes; when you
+##   only need to look at the tree, `iter_ast` doesn't have to build a new one.)
 ##
 
 
 def step2_walk_print(ast):
-    show_step("2: visiting with walk_ast")
+    show_step("2: visiting with iter_ast")
 
     # REPLACE # look in `utils.py` for more code for you to write!
-    walk_ast(ast, visit=print)  # REPLACE # FILL IN A CALL HERE to `walk_ast` with `print` as the `visit` function
+    for node, _, _ in iter_ast(ast):  # REPLACE # FILL IN A LOOP HERE over `iter_ast` that prints every node
+        print(node)  # REMOVE
 
 
 ##
@@ -124,7 +132,8 @@ def step4_subshells(ast):
                 pass # REMOVE
         return node # REMOVE
 
-    walk_ast(ast, visit=count_features)  # REPLACE # FILL IN HERE WITH CALL to `walk_ast` that counts subshells
+    for node, _, _ in iter_ast(ast):  # REPLACE # FILL IN HERE WITH a loop over `iter_ast` that counts subshells
+        count_features(node)  # REMOVE
     count = subshells.get()
     print("Number of subshells in script:", count)
     return count
@@ -151,40 +160,82 @@ def step4_subshells(ast):
 ## But it's a good start, and let's not get bogged down.
 
 
+def has_local_effect(n):
+    """
+    Does `n` itself (not counting its children) have an effect?
+    """
+    effectful = False
+
+    match n: # REPLACE # FILL IN HERE with the checks described in the comment above (use a match!)
+        # REMOVE
+        case AST.DefunNode(): # REMOVE
+            effectful = True # REMOVE
+        case AST.CommandNode() if len(n.assignments) > 0: # REMOVE
+            effectful = True # REMOVE
+        case AST.VArgChar() if n.fmt == "Assign": # REMOVE
+            effectful = True # REMOVE
+        case AST.AArgChar(): # REMOVE
+            effectful = True # REMOVE
+        case _: # REMOVE
+            pass # REMOVE
+
+    return effectful
+
+
 def is_effect_free(node):
     if node is None:
         return True
 
-    safe = True
-    def check_for_effects(n):
-        nonlocal safe
-        if not safe:
-            return
-
-        match n: # REPLACE # FILL IN HERE with the checks described in the comment above (use a match!)
-            # REMOVE
-            case AST.DefunNode(): # REMOVE
-                safe = False # REMOVE
-            case AST.CommandNode() if len(n.assignments) > 0: # REMOVE
-                safe = False # REMOVE
-            case AST.VArgChar() if n.fmt == "Assign": # REMOVE
-                safe = False # REMOVE
-            case AST.AArgChar(): # REMOVE
-                safe = False # REMOVE
-            case _: # REMOVE
-                pass # REMOVE
+    return not any(has_local_effect(n) for n, _, _ in iter_ast_node(node))
 
-    walk_ast_node(node, visit=check_for_effects)
-    return safe
+
+class EffectAnalysis:
+    """
+    Effect-freedom for every node of a tree, computed bottom-up in a single
+    traversal and kept in a side table.
+
+    Calling `is_effect_free` on every node we visit re-walks each subtree
+    once per ancestor, which is quadratic for nested `if`/`for`/`;`. Calling
+    an `EffectAnalysis` instead annotates the whole tree the first time it
+    sees its root, and then just looks nodes up.
+    """
+
+    def __init__(self):
+        # id(node) -> (node, effect free?); holding the node keeps its id valid
+        self.table = {}
+
+    def __call__(self, node) -> bool:
+        if node is None:
+            return True
+        if id(node) not in self.table:
+            self.annotate(node)
+        return self.table[id(node)][1]
+
+    def annotate(self, root):
+        # postorder, with an explicit stack so deep trees don't hit the recursion limit
+        stack = [(root, None)]
+        while stack:
+            node, children = stack.pop()
+            if children is None:
+                if id(node) in self.table:
+                    continue
+                children = ast_children(node)
+                stack.append((node, children))
+                stack.extend((child, None) for child in children)
+            else:
+                safe = not has_local_effect(node) and all(
+                    self.table[id(child)][1] for child in children
+                )
+                self.table[id(node)] = (node, safe)
 
 
 def step5_effect_free(ast):
     show_step("5: safe-to-expand top-level commands")
 
-    safe = []
+    effects = EffectAnalysis()
     # only look at top-level nodes!
     for node, _, _, _ in ast:
-        if is_effect_free(node):
+        if effects(node):
             print(f"- {node.pretty()}")
 
 
@@ -194,47 +245,58 @@ def step5_effect_free(ast):
 ##   effect-free ones. (We want to leave in effectful commands so we have variable values.)
 ##
 ##   To do this, we'll preprocess the script to stub out effect-free commands.
-##   We'll write the command we _would_ have run to a file, and we'll change the script to
-##   simply `cat` that stub (rather than running the command).
+##   We'll write the command we _would_ have run to a stub bundle (see `StubBundle` in
+##   `utils.py`), and we'll change the script to simply print that stub (rather than
+##   running the command).
 ##
 ## There are a few moving parts here:
 ##
 ##   - We have to walk the AST and find effect free nodes.
-##   - We need to save those nodes as text in a known place.
-##   - We have to alter the AST to instead cat those saved nodes.
+##   - We need to save those nodes as text in the bundle.
+##   - We have to alter the AST to instead print those saved nodes.
 ##
-## We can do all this using `walk_ast`, `is_effect_free` and a bit of care.
+## We can do all this using `walk_ast`, `is_effect_free` and a bit of care. (We actually use an
+## `EffectAnalysis`, which answers the same question as `is_effect_free` without re-walking subtrees.)
 ##
 
 
-def replace_with_cat(stub_dir="/tmp"):
-    counter = itertools.count()
+def replace_with_cat(bundle: StubBundle, effects: EffectAnalysis | None = None):
+    effects = effects or EffectAnalysis()
 
     def replace(node: AST.AstNode):
         match node:
-            case AST.Command() if is_effect_free(node):
+            case AST.Command() if effects(node):
                 # our stubs have two parts
                 #
-                #   - a file `.../cat_stub_IDX` where we hold the code we would have executed
-                #   - the new line of code we'll execute (here, `cat`ing the code in the stub file)
-
-                # stub file name
-                idx = next(counter)
-                stub_path = os.path.join(stub_dir, f"cat_stub_{idx}")
-
-                # generate stub file
-                with open(stub_path, "w", encoding="utf-8") as handle:
-                    # Whatever code you write here is catted out _at run time_
-                    # We'll just write out the line we would have executed
-                    handle.write(node.pretty()) # REPLACE handle.write("FILL IN HERE with the text of the script being replaced")
-                    handle.write("\n")
-
-                # replacement command
-                return AST.CommandNode( # REPLACE # return # FILL IN HERE with a `CommandNode` that will `cat` the file at `stub_path` (hint: checkout `string_to_argchars`)
-                    assignments = [], # guaranteed by safety to have no assignments # REMOVE
-                    line_number = getattr(node, "line_number", -1), # REMOVE
-                    arguments   = [string_to_argchars("cat"), string_to_argchars(stub_path)], # REMOVE
-                    redir_list  = [], # REMOVE
+                #   - a record in the bundle where we hold the code we would have executed
+                #   - the new line of code we'll execute (here, printing that record)
+
+                # Whatever code you write here is printed out _at run time_
+                # We'll just write out the line we would have executed
+                stub_id = bundle.add_text(node.pretty() + "\n") # REPLACE stub_id = bundle.add_text("FILL IN HERE with the text of the script being replaced")
+                start, length = bundle.text_range(stub_id)
+
+                # replacement command: `tail -c +START BUNDLE | head -c LENGTH`
+                # (`tail` counts bytes from 1)
+                line_number = getattr(node, "line_number", -1)
+                return AST.PipeNode( # REPLACE # return # FILL IN HERE with a `PipeNode` that will print the `length` bytes at `start` in `bundle.path` (hint: checkout `string_to_argchars`)
+                    is_background = False, # REMOVE
+                    items = [ # REMOVE
+                        AST.CommandNode( # REMOVE
+                            assignments = [], # guaranteed by safety to have no assignments # REMOVE
+                            line_number = line_number, # REMOVE
+                            arguments   = [string_to_argchars("tail"), string_to_argchars("-c"), # REMOVE
+                                           string_to_argchars(f"+{start + 1}"), string_to_argchars(bundle.path)], # REMOVE
+                            redir_list  = [], # REMOVE
+                        ), # REMOVE
+                        AST.CommandNode( # REMOVE
+                            assignments = [], # REMOVE
+                            line_number = line_number, # REMOVE
+                            arguments   = [string_to_argchars("head"), string_to_argchars("-c"), # REMOVE
+                                           string_to_argchars(str(length))], # REMOVE
+                            redir_list  = [], # REMOVE
+                        ), # REMOVE
+                    ], # REMOVE
                 ) # REMOVE
 
             case _:
@@ -242,10 +304,11 @@ def replace_with_cat(stub_dir="/tmp"):
 
     return replace
 
-def step6_stubs(ast):
+def step6_stubs(ast, bundle_path):
     show_step("6: preprocess script to print commands")
 
-    stubbed_ast = walk_ast(ast, replace=replace_with_cat("/tmp"))
+    with StubBundle(bundle_path) as bundle:
+        stubbed_ast = walk_ast(ast, replace=replace_with_cat(bundle))
     preprocessed_script = ast_to_code(stubbed_ast)
     print(preprocessed_script)
 
@@ -270,25 +333,21 @@ def step6_stubs(ast):
 ##
 ## Once you've filled in the code, test it out to ensure that the program runs the same!
 
-def replace_with_debug_jit(stub_dir="/tmp"):
-    counter = itertools.count()
+def replace_with_debug_jit(bundle: StubBundle, effects: EffectAnalysis | None = None):
+    effects = effects or EffectAnalysis()
 
     def replace(node: AST.AstNode):
         match node:
-            case AST.Command() if is_effect_free(node):
-                idx = next(counter)
-                stub_path = os.path.join(stub_dir, f"debug_stub_{idx}")
-
-                with open(stub_path, "w", encoding="utf-8") as handle:
-                    # we write this as text... but it's much better to store the pickled AST!
-                    handle.write(node.pretty())
-                    handle.write("\n")
+            case AST.Command() if effects(node):
+                # `debug_jit.sh` just prints and runs the stub, so we store it as text
+                stub_id = bundle.add_text(node.pretty() + "\n")
 
-                # we want to run the command `JIT_INPUT=PATH_TO_STUB . PATH_TO_JIT_SCRIPT`
+                # we want to run the command `JIT_INPUT=PATH_TO_BUNDLE JIT_STUB=STUB_ID . PATH_TO_JIT_SCRIPT`
                 return AST.CommandNode(
                     line_number = getattr(node, "line_number", -1),
                     assignments = [ # no original assignments (safe to expand!)
-                        AST.AssignNode(var="JIT_INPUT", val=string_to_argchars(stub_path)), # REPLACE # FILL IN HERE WITH an assignment of `JIT_INPUT` to the `stub_path` (hint: you need to build an `AssignNode`; use `string_of_argchars`)
+                        AST.AssignNode(var="JIT_INPUT", val=string_to_argchars(bundle.path)), # REPLACE # FILL IN HERE WITH an assignment of `JIT_INPUT` to the `bundle.path` (hint: you need to build an `AssignNode`; use `string_of_argchars`)
+                        AST.AssignNode(var="JIT_STUB", val=string_to_argchars(str(stub_id))), # REPLACE # FILL IN HERE WITH an assignment of `JIT_STUB` to the `stub_id`
                     ],
                     arguments   = [string_to_argchars("."), string_to_argchars("SOLUTION/debug_jit.sh"),], # REPLACE arguments   = [], # FILL IN HERE WITH sourcing (via `.`) the `src/debug_jit.sh` JIT script (hint: use `string_of_argchars`)
                     redir_list  = [],
@@ -299,10 +358,11 @@ def replace_with_debug_jit(stub_dir="/tmp"):
     return replace
 
 
-def step7_debug_jit(ast):
+def step7_debug_jit(ast, bundle_path):
     show_step("7: JIT stubs for debugging")
 
-    stubbed_ast = walk_ast(ast, replace=replace_with_debug_jit("/tmp"))
+    with StubBundle(bundle_path) as bundle:
+        stubbed_ast = walk_ast(ast, replace=replace_with_debug_jit(bundle))
     preprocessed_script = ast_to_code(stubbed_ast)
     print(preprocessed_script)
 
@@ -330,43 +390,542 @@ def step7_debug_jit(ast):
 ## as the original one
 ##
 
-def replace_with_jit(stub_dir="/tmp"):
-    counter = itertools.count()
+def jit_stub(
+    bundle: StubBundle, node: AST.AstNode, words: Interner, hoisting: "Hoisting | None" = None
+) -> AST.CommandNode:
+    """
+    Stubs `node` out: the command that has `jit.sh` expand and run it.
+
+    :param hoisting: The loops we're in, if its expansion can be hoisted out of them
+    """
+    # store the pickled AST, so `expand.py` doesn't have to reparse it
+    stub_id = bundle.add_stub(node)
+
+    # we want to run the command `JIT_INPUT=PATH_TO_BUNDLE JIT_STUB=STUB_ID . PATH_TO_JIT_SCRIPT`
+    assignments = [
+        AST.AssignNode(var="JIT_INPUT", val=words.word(bundle.path)),
+        AST.AssignNode(var="JIT_STUB", val=words.word(str(stub_id))),
+    ]
+
+    # if we know which variables the stub reads, `jit.sh` only needs to save those
+    variables = referenced_variables(node)
+    if variables is not None:
+        names = " ".join(sorted(filter(is_variable_name, variables)))
+        assignments.append(AST.AssignNode(var="JIT_VARS", val=[AST.QArgChar(words.word(names))]))
+
+    loop_id = hoisting.loop_for(node) if hoisting else None
+    if loop_id is not None:
+        assignments.append(AST.AssignNode(var="JIT_LOOP", val=words.word(str(loop_id))))
+
+    return AST.CommandNode(
+        line_number = first_line_number(node),
+        assignments = assignments,
+        arguments   = [words.word("."), words.word("SOLUTION/jit.sh"),],
+        redir_list  = [],
+    )
+
+
+def replace_with_jit(bundle: StubBundle, words: Interner | None = None, hoisting: "Hoisting | None" = None):
+    # every stub shares the words for the bundle, the JIT script, etc.
+    words = words if words is not None else Interner()
 
     def replace(node: AST.AstNode):
         match node:
             case AST.CommandNode():
-                idx = next(counter)
-                stub_path = os.path.join(stub_dir, f"stub_{idx}")
+                return jit_stub(bundle, node, words, hoisting)
+            case _:
+                return None
 
-                with open(stub_path, "w", encoding="utf-8") as handle:
-                    # we write this as text... but it's much better to store the pickled AST!
-                    handle.write(node.pretty())
-                    handle.write("\n")
+    return replace
 
-                # we want to run the command `JIT_INPUT=PATH_TO_STUB . PATH_TO_JIT_SCRIPT`
-                return AST.CommandNode(
-                    line_number = getattr(node, "line_number", -1),
-                    assignments = [ # no original assignments (safe to expand!)
-                        AST.AssignNode(var="JIT_INPUT", val=string_to_argchars(stub_path)),
-                    ],
-                    arguments   = [string_to_argchars("."), string_to_argchars("SOLUTION/jit.sh"),],
-                    redir_list  = [],
-                )
+
+##
+## Regions:
+##   Stubbing every command costs a JIT round trip (saving the state, starting
+##   `expand.py`, sourcing what it wrote) per command: five per iteration of a
+##   loop with five commands in its body, and one per stage (all at once) for a
+##   pipeline. With `--regions`, we stub out whole sequences, `&&`/`||` lists,
+##   `if`s, pipelines and loops instead, each expanded by a single `expand.py`
+##   call, whenever a `RegionCosts` model says that's cheaper.
+##
+##   Expanding a region in one go is only right if nothing in it changes what
+##   a later command in it expands to. `expand.py` forgets the variables a
+##   region assigns before expanding it (as `expand_stream` does), so commands
+##   reading those aren't expanded, and get a `try`: the model charges for
+##   them. Commands that change the state in ways we can't see (`read`, `eval`,
+##   `cd`, `printf -v`...) rule a region out, and so do functions: any function the script
+##   defines (before or after the region), and any name that's neither a
+##   builtin nor a program on our `PATH`, which could be a function from a
+##   sourced file or an `eval`.
+##
+
+# builtins that can change variables (or the positional parameters, or `$PWD`) without an
+# assignment, or run one that does
+STATE_BUILTINS = frozenset([
+    ".", "source", "eval", "read", "mapfile", "readarray", "getopts", "export", "declare", "typeset",
+    "local", "readonly", "unset", "let", "cd", "pushd", "popd", "shift", "set", "builtin", "command",
+])
+
+# builtins that neither change the state nor run other commands (but see `OPTION_ASSIGNMENTS`)
+PLAIN_BUILTINS = frozenset([
+    ":", "true", "false", "echo", "printf", "test", "[", "pwd", "type", "hash", "umask", "ulimit", "times",
+    "kill", "wait", "jobs", "exit", "return", "break", "continue", "shopt", "trap", "alias", "unalias",
+    "dirs", "help", "caller", "enable", "compgen", "complete", "disown", "fg", "bg", "suspend", "logout",
+])
+
+# the nodes that can be regions (commands and function definitions are handled separately)
+REGION_NODES = (AST.SemiNode, AST.AndNode, AST.OrNode, AST.IfNode, AST.PipeNode, AST.ForNode, AST.WhileNode)
+
+
+class RegionCosts(NamedTuple):
+    """
+    The cost model for `--regions`, in (roughly) JIT round trips.
+    """
+
+    jit_call: float = 1.0  # one trip through `jit.sh` and `expand.py`
+    lost_expansion: float = 4.0  # a command that can't be expanded in its region, and so runs under `try`
+    loop_iterations: float = 10.0  # how many times we guess a loop runs
+    max_commands: int = 64  # the most commands one stub can hold
+
+    @classmethod
+    def parse(cls, text: str) -> "RegionCosts":
+        """
+        The defaults, with the costs in `text` (`name=value,...`) replaced.
+        """
+        costs = {}
+        for item in filter(None, text.split(",")):
+            name, _, value = item.partition("=")
+            if name not in cls._fields:
+                raise ValueError(f"unknown cost {name!r} (known: {', '.join(cls._fields)})")
+            costs[name] = type(cls._field_defaults[name])(value)
+        return cls(**costs)
+
+
+def literal_word(arg: list) -> str | None:
+    """
+    The text of `arg`, if it's just literal characters.
+    """
+    if all(type(c) in (AST.CArgChar, LArgChar) for c in arg):
+        return AST.string_of_arg(arg)
+    return None
+
+
+def script_functions(ast: Iterable[Parsed]) -> set[str]:
+    """
+    The names of all the functions `ast` defines, wherever it defines them.
+    """
+    return {AST.string_of_arg(node.name) for node, _, _ in iter_ast(ast) if isinstance(node, AST.DefunNode)}
+
+
+@functools.cache
+def on_path(name: str) -> bool:
+    return shutil.which(name) is not None
+
+
+def is_known_command(name: str, functions: set[str] | None) -> bool:
+    """
+    Whether `name` runs a builtin that doesn't touch the state, or a program,
+    rather than a function (which could do anything).
+
+    :param functions: The functions the script defines, or `None` if we can't know them
+    """
+    if functions is None:
+        return name in PLAIN_BUILTINS
+    if name in functions:
+        return False
+    return name in PLAIN_BUILTINS or on_path(name)
+
+
+def region_costs(
+    node: AST.AstNode, costs: RegionCosts, functions: set[str] | None
+) -> tuple[float, float] | None:
+    """
+    What running `node` costs as a single stub, and with each command in it
+    stubbed on its own; `None` if it can't be a region.
+
+    :param functions: The functions the script defines (from `script_functions`), or `None` if we can't know them
+    """
+    if isinstance(node, AST.PipeNode) and node.is_background:
+        # the stub would run in the foreground
+        return None
+
+    assigned = assigned_variables(node)
+    commands = 0
+    region_cost = costs.jit_call
+    separate_cost = 0.0
+
+    # (node, how many times it runs per run of the region)
+    stack = [(node, 1.0)]
+    while stack:
+        n, runs = stack.pop()
+        match n:
+            case AST.DefunNode():
+                # expanding its body now would use the wrong state
+                return None
+            case AST.CommandNode() if n.arguments or n.assignments or n.redir_list:
+                commands += 1
+                separate_cost += costs.jit_call * runs
+                if n.arguments:
+                    name = literal_word(n.arguments[0])
+                    if name is None or name in STATE_BUILTINS or not is_known_command(name, functions):
+                        return None
+                    if option_assignments(n) != set():
+                        # (`printf -v` and the like assign behind `expand.py`'s back, too)
+                        return None
+                reads = referenced_variables(n)
+                if reads is not None and reads & assigned:
+                    region_cost += costs.lost_expansion * runs
+            case AST.CommandNode():
+                pass
+            case AST.ForNode() | AST.WhileNode():
+                stack.extend((child, runs * costs.loop_iterations) for child in ast_children(n))
+            case _:
+                stack.extend((child, runs) for child in ast_children(n))
+
+    if not 2 <= commands <= costs.max_commands:
+        return None
+    return region_cost, separate_cost
+
+
+def replace_with_region_jit(
+    bundle: StubBundle,
+    costs: RegionCosts | None = None,
+    words: Interner | None = None,
+    hoisting: "Hoisting | None" = None,
+    functions: set[str] | None = None,
+):
+    """
+    `replace_with_jit`, but stubbing out the largest regions `costs` says are
+    worth it (walk it over `REGION_NODES` and `CommandNode`).
+
+    :param functions: The functions the script defines (from `script_functions`), or `None` if we can't know them
+    """
+    costs = costs or RegionCosts()
+    words = words if words is not None else Interner()
+
+    def replace(node: AST.AstNode):
+        match node:
+            case AST.CommandNode():
+                return jit_stub(bundle, node, words, hoisting)
             case _:
+                cost = region_costs(node, costs, functions)
+                if cost is not None and cost[0] < cost[1]:
+                    return jit_stub(bundle, node, words, hoisting)
                 return None
 
     return replace
 
-def step8_try_unsafe(ast):
+
+##
+## Hoisting:
+##   A stub in a loop is expanded again on every iteration, even when nothing
+##   it reads changes from one iteration to the next. With `--hoist`, a stub
+##   reading none of the variables its loop changes is only expanded the first
+##   time it runs in each run of the loop; later iterations source the same
+##   expansion (with the `try` we prepended, or didn't) again.
+##
+##   Before a loop with hoisted stubs, `jit_loop.sh` gives the run of the loop
+##   a fresh token, and `jit.sh` reuses the expansion of a hoisted stub made
+##   under the current one. We only hoist out of loops whose every assignment
+##   we can see: no `eval`, `.`, arithmetic or function definitions in them
+##   (and builtins like `read` or `printf -v` have to name what they assign).
+##   The script's functions could change anything too, so `jit_loop.sh` checks
+##   the loop's commands aren't functions (when it runs, as they may come from
+##   another script).
+##
+
+# variables that change on their own, or with every command
+DYNAMIC_VARIABLES = frozenset([
+    "?", "!", "_", "RANDOM", "SRANDOM", "SECONDS", "LINENO", "EPOCHREALTIME", "EPOCHSECONDS",
+    "BASHPID", "BASH_COMMAND", "PIPESTATUS", "HISTCMD",
+])
+
+# the `STATE_BUILTINS` we can follow, and what they assign besides the
+# variables their arguments name (`@` stands for the positional parameters)
+BUILTIN_ASSIGNMENTS = {
+    "read": {"REPLY"},
+    "mapfile": {"MAPFILE"},
+    "readarray": {"MAPFILE"},
+    "getopts": {"OPTARG", "OPTIND"},
+    "export": set(),
+    "declare": set(),
+    "typeset": set(),
+    "local": set(),
+    "readonly": set(),
+    "unset": set(),
+    "cd": {"PWD", "OLDPWD"},
+    "pushd": {"PWD", "OLDPWD", "DIRSTACK"},
+    "popd": {"PWD", "OLDPWD", "DIRSTACK"},
+    "shift": {"@"},
+    "set": {"@", "-"},
+}
+
+# builtins that assign the variable an option of theirs names (and otherwise don't touch the state)
+OPTION_ASSIGNMENTS = {"printf": "v", "wait": "p"}
+
+# command names `jit_loop.sh` can take in a list
+LISTABLE_COMMAND = re.compile(r"[^\s\"'`$\\]+")
+
+
+def argument_name(arg: list) -> str | None:
+    """
+    What an argument of `read`, `export`, etc. would name: the text before
+    its `=`, if that's literal.
+    """
+    literal = next((i for i, c in enumerate(arg) if type(c) not in (AST.CArgChar, LArgChar)), len(arg))
+    text = AST.string_of_arg(arg[:literal])
+    if literal < len(arg) and "=" not in text:
+        return None
+    return text.partition("=")[0]
+
+
+def unquoted_text(arg: list) -> str | None:
+    """
+    The text `arg` stands for, if it's all literal characters, quoted or not.
+    """
+    text = []
+    for c in arg:
+        if type(c) is AST.QArgChar:
+            inner = unquoted_text(c.arg)
+            if inner is None:
+                return None
+            text.append(inner)
+        elif type(c) in (AST.CArgChar, AST.EArgChar):
+            text.append(chr(c.char))
+        elif type(c) is LArgChar:
+            text.append(c.text)
+        else:
+            return None
+    return "".join(text)
+
+
+def option_assignments(node: AST.CommandNode) -> set[str] | None:
+    """
+    The variables `node` assigns if it's one of the `OPTION_ASSIGNMENTS`
+    builtins (e.g., `printf -v NAME`), and the empty set for other commands;
+    `None` if we can't tell.
+    """
+    flag = OPTION_ASSIGNMENTS.get(literal_word(node.arguments[0])) if node.arguments else None
+    if flag is None:
+        return set()
+    names = set()
+    args = iter(node.arguments[1:])
+    for arg in args:
+        text = unquoted_text(arg)
+        if text is None:
+            # it could be an option
+            return None
+        if text == "--" or not text.startswith("-") or text == "-":
+            break
+        # options can be bunched (`-np ID`), and the name can follow right on (`-vNAME`)
+        at = text.find(flag, 1)
+        if at == -1:
+            continue
+        name = text[at + 1 :] or unquoted_text(next(args, []))
+        if not name or not is_variable_name(name):
+            return None
+        names.add(name)
+    return names
+
+
+def loop_variables(loop: AST.AstNode) -> tuple[set[str], set[str]] | None:
+    """
+    The variables that can change from one iteration of `loop` to the next,
+    and the names of the commands it runs; `None` if we can't tell.
+    """
+    if referenced_variables(loop) is None:
+        # arithmetic can assign
+        return None
+
+    variant = assigned_variables(loop)
+    commands = set()
+    for node, _, _ in iter_ast_node(loop):
+        match node:
+            case AST.DefunNode():
+                # then a command in the loop could be a function that isn't defined yet
+                return None
+            case AST.CommandNode() if node.arguments:
+                names = [argument_name(arg) for arg in node.arguments]
+                name = literal_word(node.arguments[0])
+                if name is None or not LISTABLE_COMMAND.fullmatch(name):
+                    return None
+                commands.add(name)
+                assigns = option_assignments(node)
+                if assigns is None:
+                    return None
+                variant |= assigns
+                if name not in STATE_BUILTINS:
+                    continue
+                if name not in BUILTIN_ASSIGNMENTS or None in names:
+                    return None
+                if name in ("declare", "typeset", "local") and any(
+                    n.startswith("-") and "n" in n for n in names[1:]
+                ):
+                    # namerefs assign to other variables
+                    return None
+                variant |= BUILTIN_ASSIGNMENTS[name]
+                variant.update(n for n in names[1:] if is_variable_name(n))
+    return variant, commands
+
+
+def is_invariant(node: AST.AstNode, variant: set[str]) -> bool:
+    """
+    Does expanding `node` come out the same while none of the `variant`
+    variables change?
+    """
+    reads = referenced_variables(node)
+    if reads is None:
+        return False
+    for name in reads | IMPLICIT_VARIABLES:
+        if name.isdigit() or name in ("@", "*", "#"):
+            name = "@"
+        if name in DYNAMIC_VARIABLES or name in variant:
+            return False
+    return True
+
+
+class Hoisting:
+    """
+    The loops a walk is in that stubs can be hoisted out of, for `jit_stub`
+    to pick the outermost one a stub's expansion is invariant in.
+    """
+
+    def __init__(self):
+        # (id, the variables that change in it), outermost first
+        self.loops: list[tuple[int, set[str]]] = []
+        self.count = 0
+        # the loops stubs were hoisted out of
+        self.hoisted = set()
+
+    def loop_for(self, node: AST.AstNode) -> int | None:
+        # an outer loop changes everything the ones inside it do
+        for loop_id, variant in self.loops:
+            if is_invariant(node, variant):
+                self.hoisted.add(loop_id)
+                return loop_id
+        return None
+
+    def handlers(self, handlers: dict, words: Interner) -> TypeTable:
+        """
+        `handlers` (whose stubs are hoisted with us), also keeping track of
+        the loops the walk goes into.
+        """
+        inner = handler_table(handlers)
+
+        def replace_loop(node: AST.AstNode):
+            replacer = inner[type(node)]
+            stubbed = replacer(node) if replacer else None
+            if stubbed is not None:
+                return stubbed
+            variables = loop_variables(node)
+            if variables is None:
+                return None
+            variant, commands = variables
+
+            self.count += 1
+            loop_id = self.count
+            self.loops.append((loop_id, variant))
+            try:
+                loop = rebuild_ast_node(node, [walk_ast_node(child, replace=table) for child in ast_children(node)])
+            finally:
+                self.loops.pop()
+            if loop_id not in self.hoisted:
+                return loop
+
+            # JIT_LOOP=ID JIT_COMMANDS="..." . jit_loop.sh
+            start = AST.CommandNode(
+                line_number = first_line_number(node),
+                assignments = [
+                    AST.AssignNode(var="JIT_LOOP", val=words.word(str(loop_id))),
+                    AST.AssignNode(var="JIT_COMMANDS", val=[AST.QArgChar(words.word(" ".join(sorted(commands))))]),
+                ],
+                arguments   = [words.word("."), words.word("SOLUTION/jit_loop.sh")],
+                redir_list  = [],
+            )
+            # (braces, so it stays one command in a pipeline or `&&` list)
+            return AST.GroupNode(AST.SemiNode(start, loop))
+
+        table = TypeTable({**handlers, AST.ForNode: replace_loop, AST.WhileNode: replace_loop})
+        return table
+
+
+def jit_handlers(
+    bundle: StubBundle,
+    costs: RegionCosts | None = None,
+    words: Interner | None = None,
+    hoist: bool = False,
+    functions: set[str] | None = None,
+) -> dict:
+    """
+    The replacers for step 8: one per command, or per region given `costs`
+    (and the script's `functions`); with `hoist`, stubs are hoisted out of loops.
+    """
+    words = words if words is not None else Interner()
+    hoisting = Hoisting() if hoist else None
+    if costs is None:
+        handlers = {AST.CommandNode: replace_with_jit(bundle, words, hoisting)}
+    else:
+        replace = replace_with_region_jit(bundle, costs, words, hoisting, functions)
+        handlers = dict.fromkeys((*REGION_NODES, AST.CommandNode), replace)
+    return hoisting.handlers(handlers, words) if hoisting else handlers
+
+
+def step8_try_unsafe(ast, bundle_path, costs: RegionCosts | None = None, hoist: bool = False):
     show_step("8: JIT expansion")
 
-    stubbed_ast = walk_ast(ast, replace=replace_with_jit(stub_dir = "/tmp"))
+    functions = script_functions(ast) if costs is not None else None
+    with StubBundle(bundle_path) as bundle:
+        stubbed_ast = walk_ast(ast, replace=jit_handlers(bundle, costs, hoist=hoist, functions=functions))
     preprocessed_script = ast_to_code(stubbed_ast)
     print(preprocessed_script)
 
     return preprocessed_script
 
+##
+## Streaming:
+##   The steps above hold the whole script (and the whole transformed script) in memory.
+##   For very large scripts, we can instead parse, transform and write out one
+##   top-level command at a time.
+##
+
+# how much of the script's words to remember for sharing, in bytes
+STREAM_WORDS_MAX_BYTES = 2 * 2**20
+
+
+def stream_try_unsafe(
+    input_script: str, output: str, bundle_path: str, costs: RegionCosts | None = None, hoist: bool = False
+) -> int:
+    """
+    Step 8, one top-level command at a time: memory is bounded by the
+    largest command rather than the whole script.
+
+    :param input_script: The script to transform (`-` for stdin)
+    :param output: Where to write the transformed script (`-` for stdout)
+    :param bundle_path: Where to write the stubs
+    :param costs: Stub out regions rather than commands, with this cost model
+    :param hoist: Hoist stubs out of loops
+    :return: The number of top-level commands
+    """
+    functions = None
+    if costs is not None and input_script != "-":
+        # a region can call a function defined further down, so look for them first
+        # (stdin can't be read twice: then any function could be anything)
+        functions = script_functions(parse_shell_to_asts(input_script))
+    count = 0
+    # long words and heredocs make for a lot of `CArgChar`s to pickle into stubs, so
+    # share words in their compact form (and don't hold on to every word in the script)
+    words = Interner(compact=True, max_bytes=STREAM_WORDS_MAX_BYTES)
+    with StubBundle(bundle_path) as bundle, open_output(output) as out_file:
+        replace = handler_table(jit_handlers(bundle, costs, words, hoist, functions))
+        for node, _, _, _ in parse_shell_to_asts(input_script, interner=words):
+            stubbed = walk_ast_node(node, replace=replace)
+            # whoever runs the output as it arrives needs the stubs it refers to
+            bundle.flush()
+            print(stubbed.pretty(), file=out_file)
+            count += 1
+    return count
+
+
 def main():
     arg_parser = argparse.ArgumentParser(
         description=f"Transform a shell script and outputs the modified script"
@@ -374,10 +933,48 @@ def main():
     arg_parser.add_argument(
         "input_script",
         type=str,
-        help="Path to the input shell script",
+        help="Path to the input shell script (`-` for stdin, with `--stream`)",
+    )
+    arg_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Only run step 8, transforming and writing out one command at a time",
+    )
+    arg_parser.add_argument(
+        "--output",
+        "-o",
+        help="Where `--stream` writes the transformed script (default: INPUT_SCRIPT.safe, or stdout for stdin)",
+    )
+    arg_parser.add_argument(
+        "--regions",
+        action="store_true",
+        help="In step 8, stub out whole regions (sequences, pipelines, loops...) where that's cheaper",
+    )
+    arg_parser.add_argument(
+        "--region-costs",
+        metavar="COSTS",
+        help="Adjust the cost model of `--regions` (which this implies) with `name=value,...` (see `RegionCosts`)",
+    )
+    arg_parser.add_argument(
+        "--hoist",
+        action="store_true",
+        help="In step 8, expand stubs that don't depend on their loop once per run of the loop",
     )
     args = arg_parser.parse_args()
     input_script = args.input_script
+    try:
+        costs = RegionCosts.parse(args.region_costs or "") if args.regions or args.region_costs is not None else None
+    except ValueError as exc:
+        arg_parser.error(str(exc))
+    # each transformed script gets its own stub bundles, in a fresh directory only we can
+    # get into: they're pickles `expand.py` loads, so nobody else may get to write them first
+    script_name = "stdin" if input_script == "-" else os.path.basename(input_script)
+    stub_prefix = os.path.join(tempfile.mkdtemp(prefix=f"{script_name}.", suffix=".stubs"), script_name)
+
+    if args.stream:
+        output = args.output or ("-" if input_script == "-" else f"{input_script}.safe")
+        stream_try_unsafe(input_script, output, f"{stub_prefix}.jit_stubs", costs, args.hoist)
+        return
 
     ## Step 1: Parse/unparse
     original_ast = step1_parse_script(input_script)
@@ -416,19 +1013,19 @@ def main():
 
     ## Step 6: Preprocess and print each command
     # REPLACE # Uncomment when you get to step 6
-    preprocessed_script = step6_stubs(original_ast) # COMMENT
+    preprocessed_script = step6_stubs(original_ast, f"{stub_prefix}.cat_stubs") # COMMENT
     with open(f"{input_script}.preprocessed.1", "w", encoding="utf-8") as out_file: # COMMENT
         print(preprocessed_script, file=out_file) # COMMENT
 
     ## Step 7: Preprocess using the JIT
     # REPLACE # Uncomment when you get to step 7
-    preprocessed_script = step7_debug_jit(original_ast) # COMMENT
+    preprocessed_script = step7_debug_jit(original_ast, f"{stub_prefix}.debug_stubs") # COMMENT
     with open(f"{input_script}.preprocessed.2", "w", encoding="utf-8") as out_file: # COMMENT
         print(preprocessed_script, file=out_file) # COMMENT
 
     ## Step 8: Preprocess using the JIT and expand before executing
     # REPLACE # Uncomment when you get to step 8
-    preprocessed_script = step8_try_unsafe(original_ast) # COMMENT
+    preprocessed_script = step8_try_unsafe(original_ast, f"{stub_prefix}.jit_stubs", costs, args.hoist) # COMMENT
     with open(f"{input_script}.safe", "w", encoding="utf-8") as out_file: # COMMENT
         print(preprocessed_script, file=out_file) # COMMENT
     print() # COMMENT
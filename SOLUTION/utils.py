@@ -1,17 +1,84 @@
-from typing import Iterable, Iterator
+import functools
+import hashlib
+import mmap
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Iterable, Iterator, NamedTuple
 
-import libdash
 from shasta import json_to_ast
 from shasta import ast_node as AST
 
 # Parses straight a shell script to an AST
 # through python bindings to dash
 # without calling dash as an executable
+#
+# (libdash is only imported once we parse something: every JIT call runs
+# `expand.py` afresh, and loading a pickled stub never needs it)
 INITIALIZE_LIBDASH = True
 type Parsed = tuple[AST.AstNode, str | None, int, int]
 
-def parse_shell_to_asts(input_script_path: str) -> Iterator[Parsed]:
+def initialize_libdash():
+    """
+    Initializes libdash now, rather than on the first parse, unless it
+    already has been in this process.
+    """
     global INITIALIZE_LIBDASH
+    if INITIALIZE_LIBDASH:
+        import ctypes
+        import libdash
+
+        libdash.parser.initialize(ctypes.CDLL(libdash.parser.libdash_library_path()))
+        INITIALIZE_LIBDASH = False
+
+
+def parse_shell_to_asts(input_script_path: str, interner: "Interner | None" = None) -> Iterator[Parsed]:
+    """
+    Parses a script (`-` for stdin) one top-level command at a time, going
+    through the parse cache when it's on.
+
+    :param interner: Share identical words (across commands, too) through
+                     this `Interner` (which converts everything right away)
+    """
+    if interner is not None:
+        # words are shared as they come out of libdash, so each distinct one is only
+        # converted once (the cache holds converted nodes, so it's no help here)
+        yield from parse_with_libdash(input_script_path, interner.to_ast_node)
+        return
+
+    cache_path = parse_cache_path(input_script_path)
+    if cache_path is None:
+        yield from parse_with_libdash(input_script_path)
+        return
+
+    try:
+        cache_file = open(cache_path, "rb")
+    except FileNotFoundError:
+        yield from parse_and_cache(input_script_path, cache_path)
+        return
+
+    with cache_file:
+        # mark it as recently used, for eviction (a cache we can only read still hits)
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        while True:
+            try:
+                yield from pickle.load(cache_file)
+            except EOFError:
+                return
+
+
+def parse_with_libdash(input_script_path: str, to_ast_node=json_to_ast.to_ast_node) -> Iterator[Parsed]:
+    global INITIALIZE_LIBDASH
+    import libdash
+
     new_ast_objects = libdash.parser.parse(input_script_path, init=INITIALIZE_LIBDASH)
     INITIALIZE_LIBDASH = False
     # Transform the untyped ast objects to typed ones
@@ -21,10 +88,302 @@ def parse_shell_to_asts(input_script_path: str) -> Iterator[Parsed]:
         linno_before,
         linno_after,
     ) in new_ast_objects:
-        typed_ast = json_to_ast.to_ast_node(untyped_ast)
+        typed_ast = to_ast_node(untyped_ast)
         yield (typed_ast, original_text, linno_before, linno_after)
 
 
+##
+## Parse cache
+##
+## Parsing (libdash, and then turning its output into `shasta` nodes) is much
+## slower than unpickling the result, so `parse_shell_to_asts` keeps the
+## parsed commands of every script it sees, keyed by the script's contents and
+## the libdash and shasta versions. Each entry is a file of pickled chunks of
+## `PARSE_CACHE_CHUNK` `Parsed` tuples, so hits stream just like misses
+## (pickling them one by one makes the cache slower and ~40% bigger).
+##
+## `JIT_PARSE_CACHE` picks the directory (the empty string turns the cache
+## off), and `JIT_PARSE_CACHE_SIZE` caps its size in bytes; past that, the
+## least recently used entries go, down to `PARSE_CACHE_EVICT_TO` of the cap.
+## Misses don't each look at the whole directory for that: the first one in a
+## process does, and later ones add what they wrote to its total, until it's
+## over the cap. (Entries other processes add are only seen at the next look,
+## so the cache can run over by what they wrote in between.)
+##
+
+# it holds pickles, so it's per user rather than somewhere shared like /tmp
+PARSE_CACHE_DIR = os.environ.get(
+    "JIT_PARSE_CACHE",
+    os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "jit_parse"),
+)
+PARSE_CACHE_MAX_BYTES = int(os.environ.get("JIT_PARSE_CACHE_SIZE", 256 * 2**20))
+PARSE_CACHE_FORMAT = 1
+PARSE_CACHE_CHUNK = 64
+PARSE_CACHE_EVICT_TO = 0.75
+
+# how big this process thinks the cache is (`None` until it first looks)
+parse_cache_bytes: int | None = None
+
+
+@functools.cache
+def parse_cache_version() -> bytes:
+    # slow to import, and only needed when we parse
+    import importlib.metadata
+
+    versions = [f"format {PARSE_CACHE_FORMAT}"]
+    for package in ("libdash", "shasta"):
+        try:
+            versions.append(f"{package} {importlib.metadata.version(package)}")
+        except importlib.metadata.PackageNotFoundError:
+            versions.append(f"{package} unknown")
+    return "\n".join(versions).encode("utf-8")
+
+
+def parse_cache_path(input_script_path: str) -> str | None:
+    """
+    Where the parse of `input_script_path` is cached (if we can cache it).
+    """
+    if not PARSE_CACHE_DIR or input_script_path == "-":
+        return None
+    with open(input_script_path, "rb") as script:
+        digest = hashlib.file_digest(script, lambda: hashlib.sha256(parse_cache_version()))
+    return os.path.join(PARSE_CACHE_DIR, digest.hexdigest())
+
+
+def parse_and_cache(input_script_path: str, cache_path: str) -> Iterator[Parsed]:
+    import tempfile
+
+    try:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PARSE_CACHE_DIR, suffix=".tmp")
+    except OSError:
+        # no cache for us, but we can still parse
+        yield from parse_with_libdash(input_script_path)
+        return
+
+    cacheable = True
+
+    def dump(chunk: list[Parsed], cache_file):
+        nonlocal cacheable
+        if not cacheable:
+            return
+        try:
+            pickle.dump(chunk, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            # pickle recurses, and some scripts (e.g., long `&&` chains) nest too deep for it;
+            # they still parse, they just don't get cached
+            cacheable = False
+
+    try:
+        with os.fdopen(fd, "wb") as cache_file:
+            chunk = []
+            for parsed in parse_with_libdash(input_script_path):
+                chunk.append(parsed)
+                if len(chunk) == PARSE_CACHE_CHUNK:
+                    # pickle before handing them out, in case the caller mutates them
+                    dump(chunk, cache_file)
+                    yield from chunk
+                    chunk = []
+            if chunk:
+                dump(chunk, cache_file)
+                yield from chunk
+        if cacheable:
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, cache_path)
+    finally:
+        # parse errors, or the caller stopping early, leave nothing behind
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    if cacheable:
+        added_to_parse_cache(size)
+
+
+def added_to_parse_cache(size: int):
+    """
+    Counts a new entry of `size` bytes, evicting if that takes the cache over
+    `PARSE_CACHE_MAX_BYTES`.
+    """
+    global parse_cache_bytes
+    if parse_cache_bytes is not None:
+        parse_cache_bytes += size
+        if parse_cache_bytes <= PARSE_CACHE_MAX_BYTES:
+            return
+    parse_cache_bytes = evict_parse_cache()
+
+
+def evict_parse_cache(max_bytes: int | None = None) -> int:
+    """
+    If the cache is over `max_bytes` (by default, `PARSE_CACHE_MAX_BYTES`),
+    removes the least recently used entries until it's down to
+    `PARSE_CACHE_EVICT_TO` of that.
+
+    :return: The size of the cache, after evicting
+    """
+    if max_bytes is None:
+        max_bytes = PARSE_CACHE_MAX_BYTES
+
+    entries = []
+    with os.scandir(PARSE_CACHE_DIR) as scan:
+        for entry in scan:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return total
+    for _, size, path in sorted(entries):
+        if total <= max_bytes * PARSE_CACHE_EVICT_TO:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+
+##
+## Stub bundles
+##
+## The JIT stubs used to be written out as shell text, one file per command,
+## which `expand.py` had to parse all over again every time the stub ran.
+## Instead, each transformed script gets a single bundle file holding all of
+## its stubs. JIT stubs are stored as pickled typed ASTs (with a little
+## metadata), so loading one never touches libdash.
+##
+## A bundle is the magic header followed by records. Each record is its
+## length in ASCII decimal, a newline, and then the payload, so that the shell
+## can pull a record out with `tail`, `read` and `head`. A stub's id is the
+## offset of its record. Records are content addressed: adding the same
+## payload twice gives back the first record's id. The bundle ends with an
+## index record (a pickled digest -> id dictionary) followed by the fixed-size
+## trailer `INDEX_ID_IN_HEX MAGIC`.
+##
+
+BUNDLE_MAGIC = b"JITBNDL1\n"
+BUNDLE_TRAILER_LEN = 16 + len(BUNDLE_MAGIC)
+
+
+class Stub(NamedTuple):
+    node: AST.AstNode
+    line_number: int
+    variables: frozenset[str] | None
+
+
+class StubBundle:
+    """
+    Writes a stub bundle. Use it as a context manager, so the index gets
+    written (and the file closed) before the transformed script is run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = {}
+        self.ranges = {}
+        self.handle = open(path, "wb")
+        self.handle.write(BUNDLE_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, payload: bytes) -> int:
+        digest = hashlib.sha256(payload).digest()
+        stub_id = self.index.get(digest)
+        if stub_id is None:
+            stub_id = self.handle.tell()
+            header = b"%d\n" % len(payload)
+            self.handle.write(header)
+            self.handle.write(payload)
+            self.index[digest] = stub_id
+            self.ranges[stub_id] = (stub_id + len(header), len(payload))
+        return stub_id
+
+    def add_text(self, text: str) -> int:
+        return self.add(text.encode("utf-8"))
+
+    def add_stub(self, node: AST.AstNode) -> int:
+        """
+        Adds a pickled JIT stub for `node`, its plain characters in
+        `LArgChar` runs. Identical commands share a stub, which keeps the line
+        number of the first one.
+        """
+        digest = hashlib.sha256(node.pretty().encode("utf-8")).digest()
+        stub_id = self.index.get(digest)
+        if stub_id is None:
+            stub = Stub(
+                node=compact_literals(node),
+                line_number=first_line_number(node),
+                variables=referenced_variables(node),
+            )
+            stub_id = self.add(pickle.dumps(stub, protocol=pickle.HIGHEST_PROTOCOL))
+            self.index[digest] = stub_id
+        return stub_id
+
+    def flush(self):
+        """
+        Makes the stubs added so far readable (by id; the index is only
+        written on `close`), e.g., before emitting commands that use them.
+        """
+        self.handle.flush()
+
+    def text_range(self, stub_id: int) -> tuple[int, int]:
+        """
+        The (0-indexed) byte offset and length of the payload of `stub_id`.
+        """
+        return self.ranges[stub_id]
+
+    def close(self):
+        if self.handle.closed:
+            return
+        index_id = self.add(pickle.dumps(self.index, protocol=pickle.HIGHEST_PROTOCOL))
+        self.handle.write(b"%016x" % index_id)
+        self.handle.write(BUNDLE_MAGIC)
+        self.handle.close()
+
+
+def read_bundle_record(bundle_path: str, stub_id: int) -> bytes:
+    with open(bundle_path, "rb") as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as bundle:
+            assert bundle[: len(BUNDLE_MAGIC)] == BUNDLE_MAGIC, f"{bundle_path} is not a stub bundle"
+            newline = bundle.find(b"\n", stub_id)
+            length = int(bundle[stub_id:newline])
+            return bundle[newline + 1 : newline + 1 + length]
+
+
+def read_bundle_index(bundle_path: str) -> dict[bytes, int]:
+    with open(bundle_path, "rb") as handle:
+        handle.seek(-BUNDLE_TRAILER_LEN, os.SEEK_END)
+        trailer = handle.read()
+    assert trailer.endswith(BUNDLE_MAGIC), f"{bundle_path} has no index"
+    return pickle.loads(read_bundle_record(bundle_path, int(trailer[:16], 16)))
+
+
+def read_stub(bundle_path: str, stub_id: int) -> Stub:
+    return pickle.loads(read_bundle_record(bundle_path, stub_id))
+
+
+def stub_to_parsed(stub: Stub) -> list[Parsed]:
+    # stubs are stored with literal runs, which `sh_expand` can't read
+    return [(split_literals(stub.node), None, stub.line_number, stub.line_number)]
+
+
+def load_stub(stub_path: str, stub_id: int | None = None) -> list[Parsed]:
+    """
+    Loads a stub as a list of `Parsed` commands.
+
+    :param stub_path: A stub bundle, or a file of plain shell text (which gets parsed)
+    :param stub_id: The id of the stub in the bundle
+    """
+    if stub_id is None:
+        return list(parse_shell_to_asts(stub_path))
+
+    return stub_to_parsed(read_stub(stub_path, stub_id))
+
+
 def ast_to_code(ast: Iterable[AST.AstNode]) -> str:
     """
     Turns an AST into a single, pretty-printed valid shell script (as a `str`).
@@ -37,289 +396,977 @@ def ast_to_code(ast: Iterable[AST.AstNode]) -> str:
     return "\n".join([node.pretty() for node in ast]) # REPLACE return # FILL IN HERE with each node in `ast` pretty-printed, compiled into a single newline-separated string
 
 
+@contextmanager
+def open_output(path: str):
+    """
+    Opens `path` for writing a script, where `-` means stdout.
+    """
+    if path == "-":
+        yield sys.stdout
+        sys.stdout.flush()
+    else:
+        with open(path, "w", encoding="utf-8") as out_file:
+            yield out_file
+
+
+##
+## Tracing
+##
+## With `JIT_TRACE=FILE` in the environment, `jit.sh`, `expand.py` and the
+## expansion server append a span for each phase of expanding a stub to FILE,
+## as Chrome trace events: load it in `chrome://tracing` or ui.perfetto.dev.
+## Timestamps are microseconds since the epoch, so the shell's
+## `$EPOCHREALTIME` and Python's clock line up. Every event is a line written
+## in one go, so writers can share the file; nobody knows who's last, so the
+## JSON array is never closed (which trace viewers accept).
+##
+
+TRACE_PATH = os.environ.get("JIT_TRACE", "")
+
+# the process the spans belong to: `None` for our own (with a track per
+# thread); `expand.py` uses the shell that ran it, so its spans nest in `jit.sh`'s
+TRACE_PID = None
+
+
+def trace_event(name: str, start_us: int, end_us: int, **args):
+    """
+    Appends a complete event (a span from `start_us` to `end_us`) to the trace.
+    """
+    import json
+
+    pid = TRACE_PID if TRACE_PID is not None else os.getpid()
+    tid = pid if TRACE_PID is not None else threading.get_native_id()
+    event = {"name": name, "cat": "jit", "ph": "X", "ts": start_us, "dur": end_us - start_us,
+             "pid": pid, "tid": tid, "args": args}
+    line = json.dumps(event) + ",\n"
+
+    fd = os.open(TRACE_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size == 0:
+            line = "[\n" + line
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def trace_span(name: str, start_us: int | None = None, **args):
+    """
+    Traces the `with` block (or, given `start_us`, everything since then) as a
+    span called `name`. The block gets `args`, to add to as it learns more
+    (e.g., the line number of a stub it loads). Without `JIT_TRACE`, does
+    nothing.
+    """
+    if not TRACE_PATH:
+        yield args
+        return
+
+    start_us = start_us if start_us is not None else time.time_ns() // 1000
+    try:
+        yield args
+    finally:
+        trace_event(name, start_us, time.time_ns() // 1000, **args)
+
+
 ##
 ## Auxiliary functions for ASTs
 ##
 
 
-def string_to_argchars(text: str) -> list[AST.ArgChar]:
+def string_to_argchars(text: str, compact: bool = False) -> list[AST.ArgChar]:
+    """
+    :param compact: Use a single `LArgChar` (for a whole word) rather than a `CArgChar` per character
+    """
+    if compact and len(text) > 1:
+        return [LArgChar(text)]
     return [AST.CArgChar(ord(ch)) for ch in text]
 
 
-def walk_ast(ast: Iterable[Parsed], visit=None, replace=None):
+##
+## Literal runs
+##
+## libdash (and `string_to_argchars`) give every character of a word its own
+## `CArgChar`, so a long literal or heredoc is hundreds of thousands of
+## objects, all of which the walkers visit. An `LArgChar` holds a whole run of
+## plain characters as one string. `sh_expand` only understands `CArgChar`s,
+## so ASTs go back to one character per `CArgChar` (`split_literals`) before
+## they're expanded.
+##
+
+
+class LArgChar(AST.ArgChar):
+    NodeName = "L"
+    text: str
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return self.format()
+
+    def format(self) -> str:
+        return self.text
+
+    def json(self):
+        return AST.make_kv(LArgChar.NodeName, self.text)
+
+    def pretty(self, quote_mode=AST.UNQUOTED):
+        text = self.text
+        if quote_mode == AST.QUOTED:
+            text = text.replace('"', '\\"')
+        # `string_of_arg` escapes a `$` with something after it (`literal_runs` makes sure a
+        # run only ends in `$` when it ends the word)
+        return text[:-1].replace("$", "\\$") + text[-1:]
+
+
+def literal_run(chars: list[AST.CArgChar], ends_word: bool) -> list[AST.ArgChar]:
+    tail = []
+    if not ends_word and chars and chars[-1].char == ord("$"):
+        chars, tail = chars[:-1], chars[-1:]
+    if len(chars) < 2:
+        return chars + tail
+    return [LArgChar("".join(chr(c.char) for c in chars))] + tail
+
+
+def literal_runs(arg: list[AST.ArgChar]) -> list[AST.ArgChar]:
     """
-    Visits a `Parsed` AST (i.e., a tuple of a shell AST, the original text, and line start and line end information).
+    `arg` with every run of two or more plain `CArgChar`s turned into an `LArgChar`
+    (`arg` itself if there's none).
+    """
+    compacted = []
+    run = []
+    for c in arg:
+        if type(c) is AST.CArgChar and not c.bash_mode:
+            run.append(c)
+            continue
+        compacted.extend(literal_run(run, ends_word=False))
+        compacted.append(c)
+        run = []
+    compacted.extend(literal_run(run, ends_word=True))
+    return compacted if len(compacted) < len(arg) else arg
 
-    :param ast: The parsed AST to visit.
-    :type ast: Iterable[Parsed]
-    :param visit: A visitor function (should not mutate the tree)
-    :param replace: A replacement function (returns the replacement node, should not mutate the tree)
+
+def literal_chars(arg: list[AST.ArgChar]) -> list[AST.ArgChar]:
+    """
+    `arg` with every `LArgChar` turned back into `CArgChar`s (`arg` itself if there's none).
     """
-    return [walk_ast_node(node, visit=visit, replace=replace) for node, _, _, _ in ast]
+    if not any(type(c) is LArgChar for c in arg):
+        return arg
+    chars = []
+    for c in arg:
+        if type(c) is LArgChar:
+            chars.extend(AST.CArgChar(ord(ch)) for ch in c.text)
+        else:
+            chars.append(c)
+    return chars
 
 
-def walk_ast_node(node, visit=None, replace=None):
+def map_args(node, convert):
+    """
+    `node` with `convert(arg)` applied to every argument (i.e., list of
+    `ArgChar`s) in it, inner ones (say, in quotes) first. Parts of the tree
+    where `convert` changes nothing are shared with `node`.
     """
-    Preorder visitor of shell AST nodes.
 
-    :param node: The node to visit
-    :param visit: A visitor function (should not mutate the tree)
-    :param replace: A replacement function (returns the replacement node, should not mutate the tree)
+    def replace_arg(arg):
+        if not arg or not isinstance(arg[0], AST.ArgChar):
+            # not an argument, but it may hold some
+            return None
+        walked = [c if type(c) is AST.CArgChar else walk_ast_node(c, replace=replacers) for c in arg]
+        if any(new is not old for new, old in zip(walked, arg)):
+            arg = walked
+        return convert(arg)
+
+    replacers = handler_table({list: replace_arg})
+    return walk_ast_node(node, replace=replacers)
+
+
+def compact_literals(node):
+    """
+    `node`, with its runs of plain characters as `LArgChar`s.
+    """
+    return map_args(node, literal_runs)
+
+
+def split_literals(node):
+    """
+    `node`, with one `CArgChar` per character again (as `sh_expand` needs).
+    """
+    return map_args(node, literal_chars)
+
+
+##
+## Interning
+##
+## Scripts (and the commands our replacers generate) repeat the same words
+## over and over: command names, `"$VAR"`, file names in redirections. An
+## `Interner` makes structurally identical words the same object, and gives
+## each one a small integer token, so hashing or comparing a word it has
+## seen is O(1). Parsing through one (`parse_shell_to_asts(path,
+## interner=...)`) also only converts each distinct word libdash gives us
+## once.
+##
+## Only words (arguments, i.e., lists of `ArgChar`s, and the `ArgChar`s in
+## them) are shared. `sh_expand` builds new words but assigns to the fields
+## of commands and redirections in place, so those stay unshared. Words with
+## a command substitution in them hold a command, so they aren't shared
+## either (though the words inside the substitution are).
+##
+
+
+def to_redir(untyped, arg) -> AST.AstNode:
+    k, v = untyped
+    match k:
+        case "File":
+            return AST.FileRedirNode(redir_type=v[0], fd=("fixed", v[1]), arg=arg(v[2]))
+        case "Dup":
+            return AST.DupRedirNode(dup_type=v[0], fd=("fixed", v[1]), arg=("var", arg(v[2])))
+        case "Heredoc":
+            return AST.HeredocRedirNode(heredoc_type=v[0], fd=("fixed", v[1]), arg=arg(v[2]))
+    raise ValueError(f"unknown redirection {k!r}")
+
+
+def to_typed_node(untyped, node, arg=json_to_ast.to_arg) -> AST.AstNode:
+    """
+    `json_to_ast.to_ast_node` for a single node, which gets its child nodes
+    from `node(untyped)` and its words from `arg(untyped)`. (Command
+    substitutions live in the words, and are converted with them.)
+    """
+    k, v = untyped
+
+    def redirs(untyped_redirs):
+        return [to_redir(redir, arg) for redir in untyped_redirs]
+
+    def name(text):
+        # (function and loop variable names come as strings)
+        return arg([["C", ord(ch)] for ch in text])
+
+    match k:
+        case AST.CommandNode.NodeName:
+            return AST.CommandNode(
+                line_number=v[0],
+                assignments=[AST.AssignNode(var=name, val=arg(val)) for name, val in v[1]],
+                arguments=[arg(a) for a in v[2]],
+                redir_list=redirs(v[3]),
+            )
+        case AST.PipeNode.NodeName:
+            return AST.PipeNode(is_background=v[0], items=[node(item) for item in v[1]])
+        case AST.SubshellNode.NodeName:
+            return AST.SubshellNode(line_number=v[0], body=node(v[1]), redir_list=redirs(v[2]))
+        case AST.AndNode.NodeName:
+            return AST.AndNode(left_operand=node(v[0]), right_operand=node(v[1]))
+        case AST.OrNode.NodeName:
+            return AST.OrNode(left_operand=node(v[0]), right_operand=node(v[1]))
+        case AST.SemiNode.NodeName:
+            return AST.SemiNode(left_operand=node(v[0]), right_operand=node(v[1]))
+        case AST.NotNode.NodeName:
+            return AST.NotNode(body=node(v))
+        case AST.RedirNode.NodeName:
+            return AST.RedirNode(line_number=v[0], node=node(v[1]), redir_list=redirs(v[2]))
+        case AST.BackgroundNode.NodeName:
+            return AST.BackgroundNode(line_number=v[0], node=node(v[1]), redir_list=redirs(v[2]))
+        case AST.DefunNode.NodeName:
+            return AST.DefunNode(line_number=v[0], name=name(v[1]), body=node(v[2]))
+        case AST.ForNode.NodeName:
+            return AST.ForNode(
+                line_number=v[0],
+                argument=[arg(a) for a in v[1]],
+                body=node(v[2]),
+                variable=name(v[3]),
+            )
+        case AST.WhileNode.NodeName:
+            return AST.WhileNode(test=node(v[0]), body=node(v[1]))
+        case AST.IfNode.NodeName:
+            return AST.IfNode(cond=node(v[0]), then_b=node(v[1]), else_b=node(v[2]))
+        case AST.CaseNode.NodeName:
+            cases = [{"cpattern": [arg(p) for p in case["cpattern"]], "cbody": node(case["cbody"])} for case in v[2]]
+            return AST.CaseNode(line_number=v[0], argument=arg(v[1]), cases=cases)
+    raise ValueError(f"unknown node {k!r}")
+
+
+class Interner:
     """
-    if visit:
-        visit(node)
-    if replace:
-        replaced = replace(node)
-        if replaced is not None:
-            return replaced
+    A table of shared words. Keep it alive for as long as its tokens are used.
+    """
+
+    def __init__(self, compact: bool = False, max_bytes: int | None = None):
+        """
+        :param compact: Share words with their literal runs as `LArgChar`s
+        :param max_bytes: Past about this many bytes of words (and their
+                          keys), start over (so tokens from before aren't
+                          comparable to those after); a word bigger than
+                          that on its own isn't shared at all
+        """
+        self.compact = compact
+        self.max_bytes = max_bytes
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.tokens = {}  # structural key -> token
+        self.shared = []  # token -> the shared word
+        self.token_of = {}  # id(shared word) -> token
+        self.words = {}  # text -> shared word, for `word`
+        self.untyped_words = {}  # repr of libdash's word -> shared word, for `to_arg`
+        self.size = 0  # roughly, the bytes all that takes
+
+    def token(self, word) -> int | None:
+        """
+        The structural hash of a word this interner has handed out: equal
+        tokens mean equal words. `None` for anything else.
+        """
+        return self.token_of.get(id(word))
+
+    def make_room(self, size: int) -> bool:
+        """
+        Counts `size` more bytes in the table, or clears it if they wouldn't
+        fit. `False` if they don't go in: they never would, or the table was
+        just cleared (and their key may hold tokens from before).
+        """
+        if self.max_bytes is None:
+            return True
+        if size > self.max_bytes:
+            return False
+        if self.size + size > self.max_bytes:
+            self.clear()
+            return False
+        self.size += size
+        return True
+
+    def share(self, key: tuple, word):
+        token = self.tokens.get(key)
+        if token is not None:
+            self.hits += 1
+            return self.shared[token]
+        self.misses += 1
+        # the text in the key (which the word holds too), and a pointer or so per field
+        if not self.make_room(sum(len(k) if type(k) is str else 8 for k in key)):
+            return word
+        token = len(self.shared)
+        self.tokens[key] = token
+        self.shared.append(word)
+        self.token_of[id(word)] = token
+        return word
+
+    def intern_argchar(self, c: AST.ArgChar) -> AST.ArgChar:
+        if id(c) in self.token_of:
+            return c
+        # exact classes: this runs on every character, and ABC `isinstance` is slow
+        cls = type(c)
+        if cls is AST.CArgChar:
+            return self.share(("C", c.char, c.bash_mode), c)
+        if cls is LArgChar:
+            return self.share(("L", c.text), c)
+        if cls is AST.EArgChar:
+            return self.share(("E", c.char), c)
+        if cls is AST.TArgChar:
+            # libdash gives us the user name as a list, sometimes
+            return self.share(("T", repr(c.string)), c)
+        if cls not in (AST.QArgChar, AST.AArgChar, AST.VArgChar):
+            # command substitutions (and anything we don't know)
+            return c
+
+        arg = self.intern_arg(c.arg)
+        if arg is not c.arg:
+            c = copy_with(c, arg=arg)
+        token = self.token(arg)
+        if token is None:
+            return c
+        if cls is AST.VArgChar:
+            return self.share(("V", c.fmt, c.null, c.var, token), c)
+        return self.share((c.NodeName, token), c)
+
+    def intern_arg(self, arg: list[AST.ArgChar]) -> list[AST.ArgChar]:
+        if id(arg) in self.token_of:
+            return arg
+        if self.compact:
+            arg = literal_runs(arg)
+        chars = [self.intern_argchar(c) for c in arg]
+        if any(new is not old for new, old in zip(chars, arg)):
+            arg = chars
+        tokens = tuple(self.token_of.get(id(c)) for c in arg)
+        if None in tokens:
+            return arg
+        return self.share(("arg", *tokens), arg)
+
+    def intern(self, node):
+        """
+        `node`, with every word in it shared.
+        """
+        return map_args(node, self.intern_arg)
+
+    def to_ast_node(self, untyped) -> AST.AstNode:
+        """
+        `json_to_ast.to_ast_node`, sharing words as it goes.
+        """
+        return to_typed_node(untyped, self.to_ast_node, self.to_arg)
+
+    def to_arg(self, untyped_arg: list) -> list[AST.ArgChar]:
+        """
+        `json_to_ast.to_arg`, shared. A word libdash gave us before isn't converted again.
+        """
+        key = repr(untyped_arg)
+        arg = self.untyped_words.get(key)
+        if arg is not None:
+            self.hits += 1
+            return arg
+        arg = json_to_ast.to_arg(untyped_arg)
+        if "'B'" in key or "'P'" in key:
+            # (maybe) a command or process substitution, which holds a command
+            return map_args(arg, self.intern_arg)
+        arg = self.intern_arg(arg)
+        if self.make_room(len(key)):
+            self.untyped_words[key] = arg
+        return arg
+
+    def word(self, text: str) -> list[AST.ArgChar]:
+        """
+        The shared `string_to_argchars(text)` (or `string_to_argchars(text, compact=True)`).
+        """
+        word = self.words.get(text)
+        if word is None:
+            word = self.intern_arg(string_to_argchars(text))
+            if self.make_room(len(text)):
+                self.words[text] = word
+        return word
+
+    def __len__(self):
+        return len(self.shared)
+
+    def __repr__(self):
+        return f"Interner: {len(self)} shared words, {self.hits} hits, {self.misses} misses"
+
+
+# `sh_expand` looks these up no matter which variables a command mentions
+IMPLICIT_VARIABLES = frozenset(["IFS", "HOME", "-"])
+
+
+def referenced_variables(node: AST.AstNode) -> frozenset[str] | None:
+    """
+    The names of all variables that expanding `node` reads: those in parameter
+    expansions, plus `HOME` for tildes.
+
+    Returns `None` if we can't tell statically, i.e., when there's arithmetic
+    (which refers to variables by bare name).
+    """
+    names = set()
+    known = True
+
+    def unknown(n):
+        nonlocal known
+        known = False
+        return STOP
+
+    walk_ast_node(
+        node,
+        visit={
+            AST.VArgChar: lambda n: names.add(n.var),
+            AST.TArgChar: lambda n: names.add("HOME"),
+            AST.AArgChar: unknown,
+        },
+    )
+    return frozenset(names) if known else None
+
+
+def first_line_number(node: AST.AstNode) -> int:
+    """
+    The line number of `node` or, for nodes that don't have one (e.g., `;`),
+    of the first command in it; -1 if there's none.
+    """
+    for n, _, _ in iter_ast_node(node):
+        line_number = getattr(n, "line_number", None)
+        if line_number is not None:
+            return line_number
+    return -1
+
+
+def assigned_variables(node: AST.AstNode) -> set[str]:
+    """
+    The names of the variables `node` assigns syntactically: plain
+    assignments, `${x=...}`-style expansions, and `for` loop variables.
+    """
+    names = set()
+    walk_ast_node(
+        node,
+        visit={
+            AST.AssignNode: lambda n: names.add(n.var),
+            AST.VArgChar: lambda n: names.add(n.var) if n.fmt == "Assign" else None,
+            AST.ForNode: lambda n: names.add(AST.string_of_arg(n.variable)),
+        },
+    )
+    return names
+
+
+def is_variable_name(name: str) -> bool:
+    """
+    Is `name` an ordinary shell variable (as opposed to a special or positional parameter)?
+    """
+    return re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) is not None
+
+
+class TypeTable(dict):
+    """
+    A dict from classes to values, where a class without an entry of its own
+    gets the value of its nearest registered base class (or `default`). The
+    answer is remembered, so looking up a class is a single dict lookup.
+    """
+
+    def __init__(self, registered: dict | None = None, default=None):
+        super().__init__()
+        self.registered = dict(registered or {})
+        self.default = default
+
+    def register(self, cls: type, value):
+        self.registered[cls] = value
+        self.clear()
+
+    def __missing__(self, cls: type):
+        value = next(
+            (self.registered[base] for base in cls.__mro__ if base in self.registered),
+            self.default,
+        )
+        self[cls] = value
+        return value
+
+
+# no handlers for anything; shared, so walks without handlers don't each start from an empty cache
+NO_HANDLERS = TypeTable()
+
+
+def handler_table(handlers) -> TypeTable:
+    """
+    :param handlers: `None`, a function to call on every node, or a dict from node classes to
+                     functions (nodes of other classes are skipped)
+    """
+    match handlers:
+        case TypeTable():
+            return handlers
+        case None:
+            return NO_HANDLERS
+        case dict():
+            return TypeTable(handlers)
+        case _:
+            return TypeTable(default=handlers)
+
+
+def copy_with(node, /, **fields):
+    """
+    A shallow copy of `node` with `fields` replaced.
+    """
+    new = object.__new__(type(node))
+    new.__dict__.update(vars(node))
+    new.__dict__.update(fields)
+    return new
+
+
+def fd_children(fd) -> list:
+    match fd:
+        case ("var", argchars):
+            return [argchars]
+        case _:
+            return []
+
+
+def ast_children(node) -> list:
+    """
+    The children of `node` that `walk_ast_node` would visit, in order.
+    """
+    match node:
+        case list() | tuple():
+            return list(node)
+        case AST.CArgChar() | LArgChar() | AST.EArgChar() | AST.TArgChar():
+            return []
+        case AST.BArgChar():
+            return [node.node]
+        case AST.QArgChar() | AST.AArgChar() | AST.VArgChar():
+            return [node.arg]
+        case AST.PipeNode():
+            return list(node.items)
+        case AST.CommandNode():
+            return [*node.assignments, *node.arguments, *node.redir_list] # REPLACE return # FILL IN HERE WITH the children of a `CommandNode` (its assignments, then arguments, then redirections)
+        case AST.AssignNode():
+            return [node.val]
+        case AST.DefunNode() | AST.NotNode() | AST.GroupNode():
+            return [node.body]
+        case AST.ForNode():
+            return [node.body, *node.argument, node.variable]
+        case AST.WhileNode():
+            return [node.test, node.body]
+        case AST.SemiNode() | AST.AndNode() | AST.OrNode():
+            return [node.left_operand, node.right_operand]
+        case AST.IfNode():
+            return [node.cond, node.then_b] + ([node.else_b] if node.else_b else [])
+        case AST.CaseNode():
+            # `walk_ast_node` walks the cases before the scrutinee
+            children = []
+            for case in node.cases:
+                children.extend(case.get("cpattern", []))
+                if case.get("cbody"):
+                    children.append(case["cbody"])
+            children.append(node.argument)
+            return children
+        case AST.SubshellNode():
+            return [node.body, *node.redir_list]
+        case AST.RedirNode():
+            return [node.node, *node.redir_list]
+        case AST.BackgroundNode():
+            children = [node.node, *node.redir_list]
+            if node.after_ampersand:
+                children.append(node.after_ampersand)
+            return children
+        case AST.FileRedirNode():
+            return [node.arg] if node.arg else []
+        case AST.HeredocRedirNode():
+            return [node.arg]
+        case AST.DupRedirNode():
+            return fd_children(node.fd) + fd_children(node.arg)
+        case AST.SingleArgRedirNode():
+            return fd_children(node.fd)
+        case _:
+            return []
+
 
-    def walk_fd(fd):
+def rebuild_ast_node(node, children: list):
+    """
+    A copy of `node` whose children (as listed by `ast_children`) are replaced
+    by `children`.
+    """
+    def rebuild_fd(fd, rest):
         match fd:
-            case ("var", argchars):
-                return ("var", walk_ast_node(argchars, visit=visit, replace=replace))
+            case ("var", _):
+                return ("var", next(rest))
             case _:
                 return fd
 
     match node:
         case list():
-            return [walk_ast_node(n, visit=visit, replace=replace) for n in node]
+            return children
         case tuple():
-            return tuple(walk_ast_node(n, visit=visit, replace=replace) for n in node)
-        case AST.BArgChar():
-            return AST.BArgChar(
-                node=walk_ast_node(node.node, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "node"},
-            )
-        case AST.QArgChar():
-            return AST.QArgChar(
-                arg=walk_ast_node(node.arg, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "arg"},
-            )
-        case AST.AArgChar():
-            return AST.AArgChar(
-                arg=walk_ast_node(node.arg, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "arg"},
-            )
-        case AST.VArgChar():
-            return AST.VArgChar(
-                arg=walk_ast_node(node.arg, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "arg"},
-            )
-        case AST.CArgChar() | AST.EArgChar() | AST.TArgChar():
+            return tuple(children)
+        case AST.CArgChar() | LArgChar() | AST.EArgChar() | AST.TArgChar():
             return node
+        case AST.BArgChar():
+            return copy_with(node, node=children[0])
+        case AST.QArgChar() | AST.AArgChar() | AST.VArgChar():
+            return copy_with(node, arg=children[0])
         case AST.PipeNode():
-            return AST.PipeNode(
-                items=[
-                    walk_ast_node(n, visit=visit, replace=replace) for n in node.items
-                ],
-                **{k: v for k, v in vars(node).items() if k != "items"},
-            )
+            return copy_with(node, items=children)
         case AST.CommandNode():
-            # REPLACE # FILL IN HERE WITH the code for visiting a `CommandNode`
-            assignments = [ # REMOVE
-                walk_ast_node(ass, visit=visit, replace=replace) # REMOVE
-                for ass in node.assignments # REMOVE
-            ] # REMOVE
-            arguments = [ # REMOVE
-                walk_ast_node(arg, visit=visit, replace=replace) # REMOVE
-                for arg in node.arguments # REMOVE
-            ] # REMOVE
-            redirs = [ # REMOVE
-                walk_ast_node(r, visit=visit, replace=replace) for r in node.redir_list # REMOVE
-            ] # REMOVE
-            return AST.CommandNode( # REPLACE return # FILL IN HERE WITH the recomputed `CommandNode`
-                arguments=arguments, # REMOVE
-                assignments=assignments, # REMOVE
-                redir_list=redirs, # REMOVE
-                **{ # REMOVE
-                    k: v # REMOVE
-                    for k, v in vars(node).items() # REMOVE
-                    if k not in ("arguments", "assignments", "redir_list") # REMOVE
-                }, # REMOVE
+            # REPLACE # FILL IN HERE WITH the `CommandNode` built from `children` (in the order `ast_children` lists them)
+            n_assignments = len(node.assignments) # REMOVE
+            n_arguments = len(node.arguments) # REMOVE
+            return copy_with( # REPLACE return # FILL IN HERE WITH the recomputed `CommandNode`
+                node, # REMOVE
+                assignments=children[:n_assignments], # REMOVE
+                arguments=children[n_assignments : n_assignments + n_arguments], # REMOVE
+                redir_list=children[n_assignments + n_arguments :], # REMOVE
             ) # REMOVE
         case AST.AssignNode():
-            return AST.AssignNode(
-                val=walk_ast_node(node.val, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "val"},
-            )
-        case AST.DefunNode():
-            return AST.DefunNode(
-                body=walk_ast_node(node.body, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "body"},
-            )
+            return copy_with(node, val=children[0])
+        case AST.DefunNode() | AST.NotNode() | AST.GroupNode():
+            return copy_with(node, body=children[0])
         case AST.ForNode():
-            return AST.ForNode(
-                body=walk_ast_node(node.body, visit=visit, replace=replace),
-                argument=[
-                    walk_ast_node(n, visit=visit, replace=replace)
-                    for n in node.argument
-                ],
-                variable=walk_ast_node(node.variable, visit=visit, replace=replace),
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("body", "argument", "variable")
-                },
-            )
+            return copy_with(node, body=children[0], argument=children[1:-1], variable=children[-1])
         case AST.WhileNode():
-            return AST.WhileNode(
-                test=walk_ast_node(node.test, visit=visit, replace=replace),
-                body=walk_ast_node(node.body, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k not in ("test", "body")},
-            )
-        case AST.SemiNode():
-            return AST.SemiNode(
-                left_operand=walk_ast_node(
-                    node.left_operand, visit=visit, replace=replace
-                ),
-                right_operand=walk_ast_node(
-                    node.right_operand, visit=visit, replace=replace
-                ),
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("left_operand", "right_operand")
-                },
-            )
-        case AST.AndNode():
-            return AST.AndNode(
-                left_operand=walk_ast_node(
-                    node.left_operand, visit=visit, replace=replace
-                ),
-                right_operand=walk_ast_node(
-                    node.right_operand, visit=visit, replace=replace
-                ),
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("left_operand", "right_operand")
-                },
-            )
-        case AST.OrNode():
-            return AST.OrNode(
-                left_operand=walk_ast_node(
-                    node.left_operand, visit=visit, replace=replace
-                ),
-                right_operand=walk_ast_node(
-                    node.right_operand, visit=visit, replace=replace
-                ),
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("left_operand", "right_operand")
-                },
-            )
-        case AST.NotNode():
-            return AST.NotNode(
-                body=walk_ast_node(node.body, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "body"},
-            )
+            return copy_with(node, test=children[0], body=children[1])
+        case AST.SemiNode() | AST.AndNode() | AST.OrNode():
+            return copy_with(node, left_operand=children[0], right_operand=children[1])
         case AST.IfNode():
-            return AST.IfNode(
-                cond=walk_ast_node(node.cond, visit=visit, replace=replace),
-                then_b=walk_ast_node(node.then_b, visit=visit, replace=replace),
-                else_b=(
-                    walk_ast_node(node.else_b, visit=visit, replace=replace)
-                    if node.else_b
-                    else None
-                ),
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("cond", "then_b", "else_b")
-                },
+            return copy_with(
+                node,
+                cond=children[0],
+                then_b=children[1],
+                else_b=children[2] if len(children) > 2 else node.else_b,
             )
         case AST.CaseNode():
-            updated_cases = []
+            rest = iter(children)
+            cases = []
             for case in node.cases:
                 new_case = dict(case)
                 if "cpattern" in case:
-                    new_case["cpattern"] = [
-                        walk_ast_node(p, visit=visit, replace=replace)
-                        for p in case["cpattern"]
-                    ]
+                    new_case["cpattern"] = [next(rest) for _ in case["cpattern"]]
                 if case.get("cbody"):
-                    new_case["cbody"] = walk_ast_node(
-                        case["cbody"], visit=visit, replace=replace
-                    )
-                updated_cases.append(new_case)
-            return AST.CaseNode(
-                argument=walk_ast_node(node.argument, visit=visit, replace=replace),
-                cases=updated_cases,
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("argument", "cases")
-                },
-            )
+                    new_case["cbody"] = next(rest)
+                cases.append(new_case)
+            return copy_with(node, cases=cases, argument=next(rest))
         case AST.SubshellNode():
-            return AST.SubshellNode(
-                body=walk_ast_node(node.body, visit=visit, replace=replace),
-                redir_list=[
-                    walk_ast_node(r, visit=visit, replace=replace)
-                    for r in node.redir_list
-                ],
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("body", "redir_list")
-                },
-            )
-        case AST.BackgroundNode():
-            return AST.BackgroundNode(
-                node=walk_ast_node(node.node, visit=visit, replace=replace),
-                redir_list=[
-                    walk_ast_node(r, visit=visit, replace=replace)
-                    for r in node.redir_list
-                ],
-                after_ampersand=(
-                    walk_ast_node(node.after_ampersand, visit=visit, replace=replace)
-                    if node.after_ampersand
-                    else None
-                ),
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("node", "redir_list", "after_ampersand")
-                },
-            )
+            return copy_with(node, body=children[0], redir_list=children[1:])
         case AST.RedirNode():
-            return AST.RedirNode(
-                node=walk_ast_node(node.node, visit=visit, replace=replace),
-                redir_list=[
-                    walk_ast_node(r, visit=visit, replace=replace)
-                    for r in node.redir_list
-                ],
-                **{
-                    k: v
-                    for k, v in vars(node).items()
-                    if k not in ("node", "redir_list")
-                },
+            return copy_with(node, node=children[0], redir_list=children[1:])
+        case AST.BackgroundNode():
+            n_redirs = len(node.redir_list)
+            return copy_with(
+                node,
+                node=children[0],
+                redir_list=children[1 : 1 + n_redirs],
+                after_ampersand=children[1 + n_redirs] if node.after_ampersand else node.after_ampersand,
             )
         case AST.FileRedirNode():
-            return AST.FileRedirNode(
-                arg=(
-                    walk_ast_node(node.arg, visit=visit, replace=replace)
-                    if node.arg
-                    else None
-                ),
-                **{k: v for k, v in vars(node).items() if k != "arg"},
-            )
-        case AST.DupRedirNode():
-            return AST.DupRedirNode(
-                fd=walk_fd(node.fd),
-                arg=walk_fd(node.arg),
-                **{k: v for k, v in vars(node).items() if k not in ("fd", "arg")},
-            )
+            return copy_with(node, arg=children[0]) if node.arg else node
         case AST.HeredocRedirNode():
-            return AST.HeredocRedirNode(
-                arg=walk_ast_node(node.arg, visit=visit, replace=replace),
-                **{k: v for k, v in vars(node).items() if k != "arg"},
-            )
+            return copy_with(node, arg=children[0])
+        case AST.DupRedirNode():
+            rest = iter(children)
+            return copy_with(node, fd=rebuild_fd(node.fd, rest), arg=rebuild_fd(node.arg, rest))
         case AST.SingleArgRedirNode():
-            return AST.SingleArgRedirNode(
-                fd=walk_fd(node.fd),
-                **{k: v for k, v in vars(node).items() if k != "fd"},
-            )
+            return copy_with(node, fd=rebuild_fd(node.fd, iter(children)))
         case _:
             return node
+
+
+# what the walkers call to get at (and rebuild) the children of each class of node
+AST_CHILDREN = TypeTable(default=ast_children)
+AST_REBUILDERS = TypeTable(default=rebuild_ast_node)
+
+## # REMOVE
+## The walkers' fast path: `ast_children` and `rebuild_ast_node` go through # REMOVE
+## a `match` with a case per class, which for a `CommandNode` means a dozen # REMOVE
+## `isinstance` checks against shasta's ABCs, on every node of every walk. # REMOVE
+## Instead, each class gets its own pair of functions, generated at import # REMOVE
+## time from the fields holding its children: # REMOVE
+## # REMOVE
+##   "name"   a single child # REMOVE
+##   "*name"  a list of children # REMOVE
+##   "?name"  a child that may be missing (i.e., falsy) # REMOVE
+##   "&name"  a file descriptor, which is a child only when it's `("var", argchars)` # REMOVE
+## # REMOVE
+## (in the order `ast_children` lists them; `bench/walk.py` checks they agree). # REMOVE
+## # REMOVE
+AST_CHILD_FIELDS: dict[type, tuple[str, ...]] = { # REMOVE
+    AST.CArgChar: (), # REMOVE
+    LArgChar: (), # REMOVE
+    AST.EArgChar: (), # REMOVE
+    AST.TArgChar: (), # REMOVE
+    AST.BArgChar: ("node",), # REMOVE
+    AST.QArgChar: ("arg",), # REMOVE
+    AST.AArgChar: ("arg",), # REMOVE
+    AST.VArgChar: ("arg",), # REMOVE
+    AST.PipeNode: ("*items",), # REMOVE
+    AST.CommandNode: ("*assignments", "*arguments", "*redir_list"), # REMOVE
+    AST.AssignNode: ("val",), # REMOVE
+    AST.DefunNode: ("body",), # REMOVE
+    AST.NotNode: ("body",), # REMOVE
+    AST.ForNode: ("body", "*argument", "variable"), # REMOVE
+    AST.WhileNode: ("test", "body"), # REMOVE
+    AST.SemiNode: ("left_operand", "right_operand"), # REMOVE
+    AST.AndNode: ("left_operand", "right_operand"), # REMOVE
+    AST.OrNode: ("left_operand", "right_operand"), # REMOVE
+    AST.IfNode: ("cond", "then_b", "?else_b"), # REMOVE
+    AST.SubshellNode: ("body", "*redir_list"), # REMOVE
+    AST.BackgroundNode: ("node", "*redir_list", "?after_ampersand"), # REMOVE
+    AST.RedirNode: ("node", "*redir_list"), # REMOVE
+    AST.FileRedirNode: ("?arg",), # REMOVE
+    AST.HeredocRedirNode: ("arg",), # REMOVE
+    AST.DupRedirNode: ("&fd", "&arg"), # REMOVE
+    AST.SingleArgRedirNode: ("&fd",), # REMOVE
+    AST.GroupNode: ("body",), # REMOVE
+} # REMOVE
+# REMOVE
+# REMOVE
+def make_traversal(cls: type, fields: tuple[str, ...]): # REMOVE
+    """ # REMOVE
+    Generates the `children(node)` and `rebuild(node, children)` functions for # REMOVE
+    a class with the given child fields (see `AST_CHILD_FIELDS`). # REMOVE
+    """ # REMOVE
+    if not fields: # REMOVE
+        return lambda node: [], lambda node, children: node # REMOVE
+# REMOVE
+    items = [] # REMOVE
+    steps = [] # REMOVE
+    for field in fields: # REMOVE
+        kind, name = (field[0], field[1:]) if field[0] in "*?&" else ("", field) # REMOVE
+        match kind: # REMOVE
+            case "": # REMOVE
+                items.append(f"node.{name}") # REMOVE
+                steps += [f"new.{name} = children[i]", "i += 1"] # REMOVE
+            case "*": # REMOVE
+                items.append(f"*node.{name}") # REMOVE
+                steps += [f"n = len(node.{name})", f"new.{name} = children[i : i + n]", "i += n"] # REMOVE
+            case "?": # REMOVE
+                items.append(f"*((node.{name},) if node.{name} else ())") # REMOVE
+                steps += [f"if node.{name}:", f"    new.{name} = children[i]", "    i += 1"] # REMOVE
+            case "&": # REMOVE
+                items.append(f"*fd_children(node.{name})") # REMOVE
+                steps += [f"if fd_children(node.{name}):", f"    new.{name} = ('var', children[i])", "    i += 1"] # REMOVE
+# REMOVE
+    name = cls.__name__ # REMOVE
+    source = "\n".join( # REMOVE
+        [ # REMOVE
+            f"def {name}_children(node):", # REMOVE
+            f"    return [{', '.join(items)}]", # REMOVE
+            f"def {name}_rebuild(node, children):", # REMOVE
+            "    new = copy_with(node)", # REMOVE
+            "    i = 0", # REMOVE
+            *(f"    {step}" for step in steps), # REMOVE
+            "    return new", # REMOVE
+        ] # REMOVE
+    ) # REMOVE
+    namespace = {"copy_with": copy_with, "fd_children": fd_children} # REMOVE
+    exec(compile(source, f"<traversal of {name}>", "exec"), namespace) # REMOVE
+    return namespace[f"{name}_children"], namespace[f"{name}_rebuild"] # REMOVE
+# REMOVE
+# REMOVE
+for cls, fields in AST_CHILD_FIELDS.items(): # REMOVE
+    AST_CHILDREN.register(cls, (traversal := make_traversal(cls, fields))[0]) # REMOVE
+    AST_REBUILDERS.register(cls, traversal[1]) # REMOVE
+del cls, fields, traversal # REMOVE
+AST_CHILDREN.register(list, list) # REMOVE
+AST_REBUILDERS.register(list, lambda node, children: children) # REMOVE
+AST_CHILDREN.register(tuple, list) # REMOVE
+AST_REBUILDERS.register(tuple, lambda node, children: tuple(children)) # REMOVE
+# (`CaseNode`s keep their children in a list of dicts, so they go through `ast_children`) # REMOVE
+
+
+class Signal(Enum):
+    """
+    What a visitor (or replacer) can return to steer `walk_ast`/`walk_ast_node`.
+    """
+
+    SKIP = "skip"  # leave this node and everything under it as it is
+    STOP = "stop"  # leave this node and everything not yet visited as it is, and stop walking
+
+
+SKIP, STOP = Signal.SKIP, Signal.STOP
+
+
+def walk_ast(ast: Iterable[Parsed], visit=None, replace=None):
+    """
+    Visits a `Parsed` AST (i.e., a tuple of a shell AST, the original text, and line start and line end information).
+
+    :param ast: The parsed AST to visit.
+    :type ast: Iterable[Parsed]
+    :param visit: A visitor function (should not mutate the tree), or a dict from node classes to visitor functions
+    :param replace: A replacement function (returns the replacement node, should not mutate the tree), or a dict
+                    from node classes to replacement functions
+    """
+    visit, replace = handler_table(visit), handler_table(replace)
+    walked = []
+    stopped = False
+    for node, _, _, _ in ast:
+        if not stopped:
+            node, stopped = walk_ast_node_until_stopped(node, visit, replace)
+        walked.append(node)
+    return walked
+
+
+def walk_ast_node(node, visit=None, replace=None):
+    """
+    Preorder visitor of shell AST nodes.
+
+    The walk uses an explicit stack, so long `;` chains don't run into the
+    recursion limit, and it shares structure: a node is only copied if
+    something under it was replaced, otherwise you get the original back.
+
+    Passing a dict of handlers (e.g., `replace={AST.CommandNode: f}`) only
+    calls them on nodes of those classes (or their subclasses). Handlers can
+    return `SKIP` to leave a node's subtree alone, or `STOP` to finish early.
+
+    :param node: The node to visit
+    :param visit: A visitor function (should not mutate the tree), or a dict from node classes to visitor functions
+    :param replace: A replacement function (returns the replacement node, should not mutate the tree), or a dict
+                    from node classes to replacement functions
+    """
+    return walk_ast_node_until_stopped(node, handler_table(visit), handler_table(replace))[0]
+
+
+def walk_ast_node_until_stopped(node, visit_for: TypeTable, replace_for: TypeTable) -> tuple:
+    """
+    `walk_ast_node`, but also says whether a handler returned `STOP`.
+    """
+    children_for, rebuild_for = AST_CHILDREN, AST_REBUILDERS
+
+    def finish(original, children, walked):
+        for new, old in zip(walked, children):
+            if new is not old:
+                return rebuild_for[type(original)](original, walked)
+        return original
+
+    # each frame is (node, its children, the walked children so far)
+    stack = []
+    while True:
+        cls = type(node)
+        visitor = visit_for[cls]
+        signal = visitor(node) if visitor else None
+        if signal is SKIP or signal is STOP:
+            result = node
+        else:
+            replacer = replace_for[cls]
+            result = replacer(node) if replacer else None
+            if result is SKIP or result is STOP:
+                signal, result = result, node
+            elif result is None:
+                children = children_for[cls](node)
+                if children:
+                    stack.append((node, children, []))
+                    node = children[0]
+                    continue
+                result = node
+
+        if signal is STOP:
+            # everything we haven't visited yet stays as it is
+            while stack:
+                original, children, walked = stack.pop()
+                walked.append(result)
+                walked.extend(children[len(walked) :])
+                result = finish(original, children, walked)
+            return result, True
+
+        # hand the result to its parent, finishing every parent that's now done
+        while stack:
+            original, children, walked = stack[-1]
+            walked.append(result)
+            if len(walked) < len(children):
+                node = children[len(walked)]
+                break
+            stack.pop()
+            result = finish(original, children, walked)
+        else:
+            return result, False
+
+
+def contains_node(node, *classes: type) -> bool:
+    """
+    Is there a node of one of `classes` in `node`? Stops at the first one.
+    """
+    found = False
+
+    def stop(n):
+        nonlocal found
+        found = True
+        return STOP
+
+    walk_ast_node(node, visit=dict.fromkeys(classes, stop))
+    return found
+
+
+def iter_ast(ast: Iterable[Parsed]) -> Iterator[tuple]:
+    """
+    Read-only preorder traversal of a `Parsed` AST: yields `(node, parent, depth)`
+    for every node `walk_ast` would visit, in the same order, without building
+    a new tree. Top-level nodes have no parent and depth 0.
+    """
+    for node, _, _, _ in ast:
+        yield from iter_ast_node(node)
+
+
+def iter_ast_node(node, parent=None, depth: int = 0) -> Iterator[tuple]:
+    """
+    Read-only preorder traversal of `node`: yields `(node, parent, depth)`.
+    """
+    children_for = AST_CHILDREN
+    done = object()
+
+    # each frame is (iterator over the remaining children, their parent, their depth)
+    yield node, parent, depth
+    stack = [(iter(children_for[type(node)](node)), node, depth + 1)]
+    while stack:
+        children, parent, depth = stack[-1]
+        node = next(children, done)
+        if node is done:
+            stack.pop()
+            continue
+        yield node, parent, depth
+        grandchildren = children_for[type(node)](node)
+        if grandchildren:
+            stack.append((iter(grandchildren), node, depth + 1))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+##
+## Throughput of `SOLUTION/batch.py` on a synthetic corpus, for 1, 2, 4, ...
+## up to `os.cpu_count()` workers.
+##
+## Usage: python3 bench/batch.py [--scripts N] [--commands N]
+##
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+from batch import run_batch
+
+COMMANDS = [
+    'echo "Number: $i" >>"$out"',
+    "cat /tmp/in | tr a-z A-Z | sort -u",
+    'x=$(basename "$f" .sh)',
+    'for f in *.sh; do wc -l "$f"; done',
+    'rm -rf "/tmp/build-$RANDOM"',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch.py throughput")
+    parser.add_argument("--scripts", type=int, default=200)
+    parser.add_argument("--commands", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scripts = []
+        for i in range(args.scripts):
+            script = os.path.join(tmp, f"script{i}.sh")
+            with open(script, "w", encoding="utf-8") as out_file:
+                for j in range(args.commands):
+                    print(COMMANDS[(i + j) % len(COMMANDS)], file=out_file)
+            scripts.append(script)
+
+        jobs = 1
+        while True:
+            start = time.perf_counter()
+            reports = list(run_batch(scripts, os.path.join(tmp, "out"), jobs))
+            elapsed = time.perf_counter() - start
+            assert all(report["ok"] for report in reports)
+            print(f"{jobs:3} jobs {elapsed:8.2f}s {len(scripts) / elapsed:8.1f} scripts/s")
+            if jobs >= (os.cpu_count() or 1):
+                break
+            jobs = min(2 * jobs, os.cpu_count() or 1)
+
+
+if __name__ == "__main__":
+    main()
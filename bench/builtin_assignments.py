@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+##
+## Checks that transforming scripts whose builtins assign variables through
+## an option (`printf -v NAME`, `wait -p NAME`) keeps what they print: each
+## script is run as it is and as `solution.py` (with the flags it's listed
+## with) transforms it, and the outputs have to match.
+##
+## Usage: python3 bench/builtin_assignments.py
+##
+
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# (flags, script)
+CASES = [
+    (["--hoist"], """for w in one two three; do printf -v msg '%s' "$w"; echo "got $msg"; done"""),
+    (["--hoist"], """for w in a b; do printf -vout '%s-' "$w"; echo "out $out"; done"""),
+    (["--hoist"], """for w in x y; do printf '%s\\n' "$w"; echo "home $HOME"; done"""),
+    (["--regions"], """x=old; printf -v x new; echo "x is $x"; printf -vx newer; echo x is $x"""),
+    (["--regions"], """if true; then y=old; printf -v y '%s' new; echo "y is $y"; fi"""),
+    (["--regions"], """for w in 1 2; do printf -v z 'z%s' "$w"; echo "z is $z"; done"""),
+]
+
+
+def run(script: str) -> str:
+    result = subprocess.run(["bash", script], cwd=REPO, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    return result.stdout
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (flags, text) in enumerate(CASES):
+            script = os.path.join(tmp, f"case{i}.sh")
+            with open(script, "w", encoding="utf-8") as script_file:
+                print(text, file=script_file)
+            subprocess.run(
+                [sys.executable, "SOLUTION/solution.py", *flags, script],
+                cwd=REPO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+            )
+            want, got = run(script), run(script + ".safe")
+            if want != got:
+                failures += 1
+                print(f"FAIL: {' '.join(flags)} {text}")
+                print(f"  original {want!r}, transformed {got!r}")
+            else:
+                print(f"ok: {' '.join(flags)} {text}")
+
+    if failures:
+        sys.exit(f"{failures} failures")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+##
+## Checks that merging adjacent `try`s (see "Coalescing tries" in `expand.py`)
+## keeps what a script does: for lists mixing `&&`, `||`, `;`, `|` and braces,
+## under `set -e` and `pipefail` or not, and with every combination of the
+## files they remove being there or not, the expanded script exits with the
+## same status, prints the same, and leaves the same files as the original.
+## So do lists with command substitutions, which mustn't be merged at all.
+##
+## `try` is stood in for by a shell running its arguments as a script (what
+## `try` runs in the sandbox), so this checks the control flow, not sandboxing.
+##
+## Usage: python3 bench/coalesce_tries.py
+##
+
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+from expand import *  # type: ignore
+
+FILES = ("a", "b", "c", "x")
+
+LISTS = [
+    "rm {d}/x && {{ rm {d}/a; rm {d}/b; }}",
+    "{{ rm {d}/a; rm {d}/b; }} | rm {d}/c",
+    "rm {d}/a || rm {d}/b && rm {d}/c",
+    "rm {d}/a && {{ rm {d}/b || rm {d}/c; }}",
+    "{{ rm {d}/a && rm {d}/b; }} || rm {d}/c",
+    "rm {d}/a; rm {d}/b && rm {d}/c; rm {d}/x",
+    "rm {d}/a | rm {d}/b; rm {d}/c",
+    "rm {d}/x | {{ rm {d}/a || rm {d}/b; }} && rm {d}/c",
+]
+
+# words that aren't static (see `is_static`) keep their command out of a merged
+# `try`, since they would be expanded before the commands ahead of them ran
+UNMERGED_LISTS = [
+    'rm {d}/a; echo "left: $(ls {d} | wc -l)"',
+    'rm {d}/x && rm "$(touch {d}/c; echo {d}/b)"',
+    'rm {d}/a; rm {d}/b; rm "$(ls {d} | head -n 1)"',
+]
+
+MODES = ["", "set -e", "set -o pipefail"]
+
+# what `try` runs its arguments as
+FAKE_TRY = 'try() { bash -c "$*"; }'
+
+
+def expanded(line: str, variables: dict, tmp: str) -> str:
+    script = os.path.join(tmp, "script.sh")
+    out = os.path.join(tmp, "script.sh.expanded")
+    with open(script, "w", encoding="utf-8") as script_file:
+        print(line, file=script_file)
+    expand_stream(script, variables, out)
+    with open(out, encoding="utf-8") as out_file:
+        return out_file.read()
+
+
+def run(script: str, d: str, present: tuple[str, ...]) -> tuple:
+    for name in FILES:
+        path = os.path.join(d, name)
+        if name in present:
+            open(path, "w").close()
+        elif os.path.exists(path):
+            os.remove(path)
+    result = subprocess.run(["bash", "-c", script], capture_output=True, text=True)
+    return result.returncode, result.stdout, sorted(os.listdir(d))
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        d = os.path.join(tmp, "files")
+        os.makedirs(d)
+        env_path = os.path.join(tmp, "state.env")
+        with open(env_path, "w", encoding="utf-8") as env_file:
+            subprocess.run(["bash", "-c", "declare -p"], stdout=env_file, check=True)
+        bash_version = subprocess.run(
+            ["bash", "-c", "echo $BASH_VERSION"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+        for template in LISTS + UNMERGED_LISTS:
+            line = template.format(d=d)
+            variables = load_variables(env_path, bash_version)
+            merged = expanded(line, variables, tmp)
+            if template in LISTS:
+                # (under `set -e`, a list ending in `&&` or `||` keeps its `try`s)
+                assert merged.count("try ") == 1 or "; else try " in merged, f"not merged into one try: {merged}"
+
+            for mode in MODES:
+                for n in range(len(FILES) + 1):
+                    for present in itertools.combinations(FILES, n):
+                        original = run(f"{mode}\n{line} 2>/dev/null\necho after", d, present)
+                        transformed = run(f"{FAKE_TRY}\n{mode}\n{merged.strip()} 2>/dev/null\necho after", d, present)
+                        if original != transformed:
+                            failures += 1
+                            print(f"FAIL: {line!r} ({mode or 'no options'}, with {present})")
+                            print(f"  expanded: {merged.strip()}")
+                            print(f"  original {original}, merged {transformed}")
+            print(f"ok: {template.format(d='D')}")
+
+    if failures:
+        sys.exit(f"{failures} failures")
+
+
+if __name__ == "__main__":
+    main()
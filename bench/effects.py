@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+##
+## Compares asking `is_effect_free` about every command in a tree (as the stub
+## replacers used to) against a single bottom-up `EffectAnalysis`, on scripts
+## of nested `if`s.
+##
+## Usage: python3 bench/effects.py [--depths 10,20,40,80]
+##
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+from solution import *  # type: ignore
+
+
+def nested_script(depth: int) -> str:
+    lines = []
+    for i in range(depth):
+        lines.append(f"{'  ' * i}if [ \"$x{i}\" = {i} ]; then echo {i}; echo \"$y\" | wc -l")
+    for i in reversed(range(depth)):
+        lines.append(f"{'  ' * i}fi")
+    return "\n".join(lines) + "\n"
+
+
+def every_command(ast, effect_free):
+    def query(node):
+        match node:
+            case AST.Command():
+                effect_free(node)
+
+    walk_ast(ast, visit=query)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark effect analysis on nested scripts")
+    parser.add_argument("--depths", default="10,20,40,80")
+    args = parser.parse_args()
+
+    print(f"{'depth':>6} {'is_effect_free':>16} {'EffectAnalysis':>16} {'speedup':>8}")
+    for depth in map(int, args.depths.split(",")):
+        with tempfile.NamedTemporaryFile("w", suffix=".sh") as script:
+            script.write(nested_script(depth))
+            script.flush()
+            ast = list(parse_shell_to_asts(script.name))
+
+        start = time.perf_counter()
+        every_command(ast, is_effect_free)
+        naive = time.perf_counter() - start
+
+        start = time.perf_counter()
+        every_command(ast, EffectAnalysis())
+        single_pass = time.perf_counter() - start
+
+        print(f"{depth:>6} {naive * 1e3:>13.1f} ms {single_pass * 1e3:>13.1f} ms {naive / single_pass:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
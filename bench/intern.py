@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+##
+## Parses a large, repetitive script with and without an `Interner`, and
+## reports the time, the memory the parsed script holds, and the size of its
+## pickle; then counts its distinct words by token and by text.
+##
+## Usage: python3 bench/intern.py [--commands N]
+##
+
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import utils
+from shasta import ast_node as AST
+
+COMMANDS = [
+    'echo "Number: $i" >>"$out"',
+    "cat /tmp/in | tr a-z A-Z | sort -u",
+    'x=$(basename "$f" .sh)',
+    'for f in *.sh; do wc -l "$f"; done',
+    'case "$1" in start) run --now ;; stop) halt ;; *) usage ;; esac',
+    'cp "$src/$name" "$dst/$name.bak" 2>/dev/null',
+]
+
+
+def parse(script: str, interner) -> list:
+    return [node for node, _, _, _ in utils.parse_shell_to_asts(script, interner=interner)]
+
+
+def words(nodes: list) -> list:
+    found = []
+    utils.walk_ast(((node, None, 0, 0) for node in nodes), visit={list: found.append})
+    return [word for word in found if word and isinstance(word[0], AST.ArgChar)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark interning")
+    parser.add_argument("--commands", type=int, default=20000)
+    args = parser.parse_args()
+
+    utils.PARSE_CACHE_DIR = ""
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "large.sh")
+        with open(script, "w", encoding="utf-8") as out_file:
+            for i in range(args.commands):
+                print(COMMANDS[i % len(COMMANDS)], file=out_file)
+
+        print(f"{args.commands} commands")
+        print(f"{'':<16} {'parse':>10} {'memory':>10} {'pickled':>10}")
+        for name, make in (
+            ("plain", lambda: None),
+            ("interned", utils.Interner),
+            ("interned+runs", lambda: utils.Interner(compact=True)),
+        ):
+            start = time.perf_counter()
+            parse(script, make())
+            seconds = time.perf_counter() - start
+
+            tracemalloc.start()
+            interner = make()
+            nodes = parse(script, interner)
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            pickled = len(pickle.dumps(nodes, protocol=pickle.HIGHEST_PROTOCOL))
+            print(f"{name:<16} {seconds * 1e3:8.1f}ms {memory / 2**20:8.1f}MiB {pickled / 2**20:8.1f}MiB")
+
+        interner = utils.Interner()
+        # (words with a command substitution in them aren't shared)
+        found = [word for word in words(parse(script, interner)) if interner.token(word) is not None]
+        start = time.perf_counter()
+        by_token = len({interner.token(word) for word in found})
+        token_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        by_text = len({AST.string_of_arg(word) for word in found})
+        text_seconds = time.perf_counter() - start
+        print(f"{len(found)} shared words: {by_token} distinct by token in {token_seconds * 1e3:.1f}ms, "
+              f"{by_text} by text in {text_seconds * 1e3:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
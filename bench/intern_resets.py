@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+##
+## Checks that an `Interner` that keeps starting over (a small `max_bytes`)
+## still hands out the words it was given: parses a script of random
+## commands, from few enough pieces that words keep repeating, through
+## interners of several budgets, and compares every command (pickled and
+## loaded again, as stubs are) with a plain parse. Then does the same for
+## the stubs `solution.py --stream` writes, against those of an unbounded
+## interner.
+##
+## Usage: python3 bench/intern_resets.py [--commands N] [--seed S]
+##
+
+import argparse
+import os
+import pickle
+import random
+import sys
+import tempfile
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import solution
+import utils
+
+PIECES = ["deda", "cb", "cbc-b", "ed", '"${ed}"', '"$cb"', "'a b'", '"x${ed}y"', "${cb:-deda}", "-b"]
+COMMANDS = ["echo", "rm", "cat", "printf"]
+BUDGETS = [34, 64, 256, 4096]
+
+
+def random_script(path: str, commands: int, rng: random.Random):
+    with open(path, "w", encoding="utf-8") as out_file:
+        for _ in range(commands):
+            words = ["".join(rng.choices(PIECES, k=rng.randint(1, 2))) for _ in range(rng.randint(1, 4))]
+            print(rng.choice(COMMANDS), *words, file=out_file)
+
+
+def round_tripped(node) -> str:
+    return utils.split_literals(pickle.loads(pickle.dumps(node, protocol=pickle.HIGHEST_PROTOCOL))).pretty()
+
+
+def stubs(bundle: str) -> list[str]:
+    return sorted(
+        utils.split_literals(utils.read_stub(bundle, stub_id).node).pretty()
+        for stub_id in utils.read_bundle_index(bundle).values()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check interners that start over")
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    utils.PARSE_CACHE_DIR = ""
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "random.sh")
+        random_script(script, args.commands, random.Random(args.seed))
+        expected = [node.pretty() for node, _, _, _ in utils.parse_shell_to_asts(script)]
+
+        for budget in BUDGETS:
+            interner = utils.Interner(compact=True, max_bytes=budget)
+            got = [round_tripped(node) for node, _, _, _ in utils.parse_shell_to_asts(script, interner=interner)]
+            wrong = [(want, have) for want, have in zip(expected, got) if want != have]
+            failures += len(wrong)
+            print(f"max_bytes={budget:<6} {len(wrong)} wrong of {len(got)}")
+            for want, have in wrong[:3]:
+                print(f"  {want!r} came back as {have!r}")
+
+        unbounded = os.path.join(tmp, "unbounded")
+        solution.STREAM_WORDS_MAX_BYTES = None
+        solution.stream_try_unsafe(script, os.path.join(tmp, "unbounded.sh"), unbounded)
+        for budget in BUDGETS:
+            bounded = os.path.join(tmp, f"bounded{budget}")
+            solution.STREAM_WORDS_MAX_BYTES = budget
+            solution.stream_try_unsafe(script, os.path.join(tmp, "bounded.sh"), bounded)
+            wrong = len(set(stubs(bounded)) ^ set(stubs(unbounded)))
+            failures += wrong
+            print(f"--stream, max_bytes={budget:<6} {wrong} stubs differ")
+
+    if failures:
+        sys.exit(f"{failures} failures")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+##
+## Memory and walking time for a script with a large heredoc and a long
+## literal word, one `CArgChar` per character vs. `LArgChar` runs, and the
+## size of its pickled stub.
+##
+## Usage: python3 bench/literals.py [--kib N]
+##
+
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import utils
+
+
+def build(node, compact: bool):
+    # a fresh copy, so we measure everything it holds
+    node = pickle.loads(pickle.dumps(node))
+    return utils.compact_literals(node) if compact else node
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark literal runs")
+    parser.add_argument("--kib", type=int, default=200, help="Size of the heredoc (and of the literal word)")
+    args = parser.parse_args()
+
+    line = "the quick brown fox jumps over the lazy dog, again and again and again\n"
+    body = line * (args.kib * 2**10 // len(line))
+    utils.PARSE_CACHE_DIR = ""
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "large.sh")
+        with open(script, "w", encoding="utf-8") as out_file:
+            print(f"cat >out.txt <<EOF\n{body}$HOME\nEOF", file=out_file)
+            print(f"echo {'x' * len(body)}", file=out_file)
+        nodes = [node for node, _, _, _ in utils.parse_shell_to_asts(script)]
+
+    literal_bytes = 2 * len(body)
+    print(f"{literal_bytes / 2**10:.0f} KiB of literals")
+    print(f"{'':<10} {'memory':>10} {'per byte':>10} {'walk':>10} {'pretty':>10} {'stub':>10}")
+    for name, compact in (("chars", False), ("runs", True)):
+        tracemalloc.start()
+        built = [build(node, compact) for node in nodes]
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for node in built:
+            utils.walk_ast_node(node, visit=lambda n: None)
+        walk = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for node in built:
+            node.pretty()
+        pretty = time.perf_counter() - start
+
+        stub = sum(len(pickle.dumps(node, protocol=pickle.HIGHEST_PROTOCOL)) for node in built)
+        print(
+            f"{name:<10} {memory / 2**20:8.1f}MiB {memory / literal_bytes:8.1f}B {walk * 1e3:8.1f}ms "
+            f"{pretty * 1e3:8.1f}ms {stub / 2**10:8.0f}KiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
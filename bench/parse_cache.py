@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+##
+## Times `parse_shell_to_asts` on a large script with the parse cache off, on
+## a miss (parse, and fill the cache), and on a hit.
+##
+## Usage: python3 bench/parse_cache.py [--commands N]
+##
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import utils
+
+COMMANDS = [
+    'echo "Number: $i" >>"$out"',
+    "cat /tmp/in | tr a-z A-Z | sort -u",
+    'x=$(basename "$f" .sh)',
+    'for f in *.sh; do wc -l "$f"; done',
+    'case "$1" in start) run --now ;; stop) halt ;; *) usage ;; esac',
+]
+
+
+def timed(script: str) -> float:
+    start = time.perf_counter()
+    for _ in utils.parse_shell_to_asts(script):
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parse cache")
+    parser.add_argument("--commands", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "large.sh")
+        with open(script, "w", encoding="utf-8") as out_file:
+            for i in range(args.commands):
+                print(COMMANDS[i % len(COMMANDS)], file=out_file)
+
+        utils.PARSE_CACHE_DIR = ""
+        uncached = timed(script)
+        utils.PARSE_CACHE_DIR = os.path.join(tmp, "cache")
+        miss = timed(script)
+        hit = timed(script)
+
+        size = sum(entry.stat().st_size for entry in os.scandir(utils.PARSE_CACHE_DIR))
+        print(f"{args.commands} commands, {os.path.getsize(script) / 2**10:.0f} KiB script, {size / 2**20:.1f} MiB cached")
+        print(f"{'no cache':<10} {uncached * 1e3:10.1f} ms")
+        print(f"{'miss':<10} {miss * 1e3:10.1f} ms")
+        print(f"{'hit':<10} {hit * 1e3:10.1f} ms {uncached / hit:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+##
+## Reads a large `declare -p` dump (as `jit.sh` saves it without `JIT_VARS`)
+## with `read_vars_file` and as a lazy `ShellState`, after checking that both
+## give the same variables. Times loading it and looking up a few variables
+## (what expanding a stub does), and decoding every variable.
+##
+## Usage: python3 bench/shell_state.py [--variables N]
+##
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+from expand import *  # type: ignore
+
+# a bit of everything `declare -p` prints, repeated to make up the numbers
+DECLARATIONS = r"""
+declare -- "s$i=plain value $i"
+declare -x "e$i=exported $i"
+declare -i "n$i=$i"
+declare -- "q$i=$(printf 'tab\there "quotes" $dollar\nnewline')"
+declare -a "a$i=(one 'two words' '' $i)"
+declare -A "m$i=([key]=value [other]='with space' [n]=$i)"
+declare -- "u$i"
+"""
+
+
+def make_dump(path: str, variables: int):
+    rounds = max(1, variables // DECLARATIONS.strip().count("\n") + 1)
+    script = f"for i in $(seq {rounds}); do {DECLARATIONS.strip().replace(chr(10), '; ')}; done; declare -p"
+    with open(path, "w", encoding="utf-8") as dump:
+        subprocess.run(["bash", "-c", script], stdout=dump, check=True)
+
+
+def best_of(work, repeat: int = 5) -> float:
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        work()
+        seconds = min(seconds, time.perf_counter() - start)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading the saved shell state")
+    parser.add_argument("--variables", type=int, default=5000)
+    args = parser.parse_args()
+
+    bash_version = subprocess.run(
+        ["bash", "-c", "echo $BASH_VERSION"], capture_output=True, text=True, check=True
+    ).stdout.strip()
+    version = parse_bash_version(bash_version)
+    if version < (5, 2, 0):
+        sys.exit(f"needs bash 5.2 or later (this is {bash_version})")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env_path = os.path.join(tmp, "state.env")
+        make_dump(env_path, args.variables)
+
+        eager = read_vars_file(env_path, version)
+        lazy = ShellState(env_path)
+        assert dict(lazy) == eager, "ShellState disagrees with read_vars_file"
+        print(f"{len(eager)} variables, {os.path.getsize(env_path) / 2**10:.0f} KiB: identical")
+
+        # what a stub typically reads
+        names = ["IFS", "HOME", "-", "s1", "a2", "m3"]
+
+        def lookups(variables):
+            for name in names:
+                variables.get(name)
+
+        print(f"{'':<12} {'load':>10} {'+ lookups':>10} {'everything':>11}")
+        for name, load in (
+            ("eager", lambda: read_vars_file(env_path, version)),
+            ("lazy", lambda: ShellState(env_path)),
+        ):
+            print(
+                f"{name:<12} {best_of(load) * 1e3:8.2f}ms {best_of(lambda: lookups(load())) * 1e3:8.2f}ms "
+                f"{best_of(lambda: dict(load())) * 1e3:9.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
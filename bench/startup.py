@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+##
+## Checks the cold start of a JIT call against a budget. Runs `expand.py` the
+## way `jit.sh` does, on a real stub, under `python3 -X importtime`, and reports
+## the import time and wall-clock time of the process (the median of the runs)
+## and the slowest imports.
+##
+## Exits 1 if imports take longer than `--budget` milliseconds, or if the call
+## imported a module that expanding a pickled stub shouldn't need.
+##
+## Usage: python3 bench/startup.py [--budget MS] [--runs N] [--top N]
+##
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import utils
+
+EXPAND = os.path.join(SOLUTION_DIR, "expand.py")
+
+# only needed to parse, or for command lines other than the JIT's
+FORBIDDEN = ("libdash", "argparse", "importlib.metadata")
+
+
+def make_stub(tmp: str) -> tuple[str, int, str]:
+    """
+    A bundle holding one stub, with the shell state `jit.sh` would have saved
+    for it: the arguments `jit.sh` passes `expand.py`.
+    """
+    script = os.path.join(tmp, "script.sh")
+    with open(script, "w", encoding="utf-8") as out_file:
+        print('echo "hello, $name" | tr a-z A-Z >"$out"', file=out_file)
+    [(node, _, _, _)] = utils.parse_shell_to_asts(script)
+
+    bundle_path = os.path.join(tmp, "script.sh.jit_stubs")
+    with utils.StubBundle(bundle_path) as bundle:
+        stub_id = bundle.add_stub(node)
+
+    with open(f"{bundle_path}.{stub_id}.env", "w", encoding="utf-8") as env_file:
+        subprocess.run(["bash", "-c", "name=world out=/dev/null; declare -p"], stdout=env_file, check=True)
+    bash_version = subprocess.run(
+        ["bash", "-c", "echo $BASH_VERSION"], capture_output=True, text=True, check=True
+    ).stdout.strip()
+    return bundle_path, stub_id, bash_version
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int, int]]:
+    """
+    The imports `-X importtime` reported, as (module, depth, self us, cumulative us).
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # the header
+            continue
+        # the name is indented two spaces per level, after the one separating it
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def run(args: list[str], env: dict) -> tuple[float, list[tuple[str, int, int, int]]]:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", EXPAND, *args], capture_output=True, text=True, env=env
+    )
+    seconds = time.perf_counter() - start
+    if result.returncode != 0 or not result.stdout.strip():
+        sys.exit(f"expand.py failed:\n{result.stderr}")
+    return seconds, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import-time budget of a JIT call")
+    parser.add_argument("--budget", type=float, default=65, help="Import time budget, in milliseconds")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="How many of the slowest imports to show")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    # a cold start still has bytecode (otherwise we'd be timing the compiler), and isn't traced
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env.pop("JIT_TRACE", None)
+
+    utils.PARSE_CACHE_DIR = ""
+    with tempfile.TemporaryDirectory() as tmp:
+        stub_args = [str(arg) for arg in make_stub(tmp)]
+        # writes the bytecode
+        run(stub_args, env)
+
+        runs = [run(stub_args, env) for _ in range(args.runs)]
+
+    totals = [sum(cumulative for _, depth, _, cumulative in imports if depth == 0) for _, imports in runs]
+    median = statistics.median(totals) / 1e3
+    wall = statistics.median(seconds for seconds, _ in runs) * 1e3
+    print(f"{args.runs} runs: imports {median:.1f}ms (budget {args.budget:.0f}ms), process {wall:.1f}ms")
+
+    _, imports = runs[-1]
+    print(f"\n{'slowest imports':<40} {'self':>8} {'cumulative':>12}")
+    for name, depth, self_us, cumulative_us in sorted(imports, key=lambda i: -i[3])[: args.top]:
+        print(f"{'  ' * depth + name:<40} {self_us / 1e3:6.1f}ms {cumulative_us / 1e3:10.1f}ms")
+
+    failures = []
+    if median > args.budget:
+        failures.append(f"imports take {median:.1f}ms, over the {args.budget:.0f}ms budget")
+    imported = {name for _, imports in runs for name, _, _, _ in imports}
+    failures.extend(f"imported {module}" for module in FORBIDDEN if module in imported)
+    if failures:
+        print()
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
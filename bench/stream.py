@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+##
+## Compares peak memory (and time) of step 8 on a large script: all at once,
+## as `solution.py` does, versus `--stream`, one top-level command at a time.
+##
+## (libdash keeps every line of a script it parses from a file, to give us
+## the original text, so the last row streams from stdin.)
+##
+## Usage: python3 bench/stream.py [--commands N]
+##
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+from utils import *  # type: ignore
+import solution
+
+COMMANDS = [
+    'echo "Number: $i" >>"$out"',
+    "cat /tmp/in | tr a-z A-Z | sort -u",
+    'x=$(basename "$f" .sh)',
+    'for f in *.sh; do wc -l "$f"; done',
+    'rm -rf "/tmp/build-$RANDOM"',
+]
+
+
+def all_at_once(script: str, output: str, bundle_path: str):
+    ast = list(parse_shell_to_asts(script))
+    with StubBundle(bundle_path) as bundle:
+        stubbed_ast = walk_ast(ast, replace={AST.CommandNode: solution.replace_with_jit(bundle)})
+    with open(output, "w", encoding="utf-8") as out_file:
+        print(ast_to_code(stubbed_ast), file=out_file)
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streaming step 8")
+    parser.add_argument("--commands", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "large.sh")
+        with open(script, "w", encoding="utf-8") as out_file:
+            for i in range(args.commands):
+                print(COMMANDS[i % len(COMMANDS)], file=out_file)
+
+        print(f"{args.commands} commands")
+        for name, fn in [("all at once", all_at_once), ("--stream", solution.stream_try_unsafe)]:
+            output = os.path.join(tmp, "out.sh")
+            elapsed, peak = measure(fn, script, output, os.path.join(tmp, "stubs"))
+            print(f"{name:<20} {elapsed * 1e3:10.1f} ms {peak / 2**20:10.1f} MiB peak")
+
+        with open(script, "rb") as in_file:
+            os.dup2(in_file.fileno(), sys.stdin.fileno())
+        elapsed, peak = measure(solution.stream_try_unsafe, "-", output, os.path.join(tmp, "stubs"))
+        print(f"{'--stream (stdin)':<20} {elapsed * 1e3:10.1f} ms {peak / 2**20:10.1f} MiB peak")
+
+
+if __name__ == "__main__":
+    main()
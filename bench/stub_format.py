@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+##
+## Compares loading a JIT stub from its pickled form in a stub bundle
+## (`utils.load_stub`) against reparsing the shell text with libdash
+## (`utils.parse_shell_to_asts`).
+##
+## Usage: python3 bench/stub_format.py [SCRIPT] [--iterations N]
+##
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+from utils import *  # type: ignore
+
+
+def time_per_call(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def time_cold(code, iterations):
+    """Wall-clock time for a fresh interpreter to run `code`."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        subprocess.run([sys.executable, "-c", code], cwd=SOLUTION_DIR, check=True)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pickled vs. text JIT stubs")
+    parser.add_argument("script", nargs="?", default="sh/spell.sh", help="Script whose commands become stubs")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    # one stub per top-level command, in both formats
+    nodes = [node for node, _, _, _ in parse_shell_to_asts(args.script)]
+    with tempfile.TemporaryDirectory() as tmp:
+        bundle_path = os.path.join(tmp, "stubs")
+        text_stubs, pickled_stubs = [], []
+        with StubBundle(bundle_path) as bundle:
+            for i, node in enumerate(nodes):
+                text_path = os.path.join(tmp, f"text_{i}")
+                with open(text_path, "w", encoding="utf-8") as handle:
+                    handle.write(node.pretty())
+                    handle.write("\n")
+                text_stubs.append(text_path)
+                pickled_stubs.append(bundle.add_stub(node))
+
+        text = time_per_call(lambda: [list(parse_shell_to_asts(p)) for p in text_stubs], args.iterations)
+        pickled = time_per_call(lambda: [load_stub(bundle_path, i) for i in pickled_stubs], args.iterations)
+
+        print(f"{len(nodes)} stubs from {args.script}")
+        print(f"warm  text    {text * 1e6 / len(nodes):10.1f} us/stub")
+        print(f"warm  pickled {pickled * 1e6 / len(nodes):10.1f} us/stub ({text / pickled:.1f}x)")
+
+        # what `expand.py` pays on a cold start: imports plus loading one stub
+        cold_iterations = max(1, args.iterations // 20)
+        text_cold = time_cold(
+            f"from utils import *; list(parse_shell_to_asts({text_stubs[0]!r}))", cold_iterations
+        )
+        pickled_cold = time_cold(
+            f"from utils import *; load_stub({bundle_path!r}, {pickled_stubs[0]})", cold_iterations
+        )
+        print(f"cold  text    {text_cold * 1e3:10.1f} ms/process")
+        print(f"cold  pickled {pickled_cold * 1e3:10.1f} ms/process")
+
+
+if __name__ == "__main__":
+    main()
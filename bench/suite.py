@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+##
+## Microbenchmarks for every stage of the pipeline, on a synthetic script (see
+## `synthetic.py`): parsing, walking, effect analysis, unparsing, and the
+## stubbing passes of steps 6-8. Each benchmark is run `--repeat` times and
+## reports its best and median time.
+##
+## `--json` saves the results, along with the commit, the machine and the
+## script's parameters, so runs on different commits can be compared:
+## `--compare` reruns the suite and flags every benchmark that got slower
+## than the saved one by more than `--threshold` (exiting 1 if any did).
+##
+## Usage:
+##
+##   python3 bench/suite.py --json before.json
+##   python3 bench/suite.py --compare before.json [--threshold 1.2]
+##   python3 bench/suite.py --commands 5000 --depth 3 --mix heredoc=4 --only parse,walk
+##
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SOLUTION_DIR = os.path.join(BENCH_DIR, "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import utils
+from solution import *  # type: ignore
+from synthetic import generate, parse_mix
+
+
+def replacing(replacer, tmp: str):
+    """
+    A benchmark running `replacer` (a step's `replace_with_*`) over the whole
+    script, with a fresh bundle each time.
+    """
+    def run(ast):
+        with StubBundle(os.path.join(tmp, f"{replacer.__name__}.stubs")) as bundle:
+            return walk_ast(ast, replace=replacer(bundle))
+    return run
+
+
+def benchmarks(script: str, tmp: str) -> dict:
+    """
+    name -> (setup, benchmark): `setup()` is untimed, and its result is what
+    the benchmark gets.
+    """
+    def parsed():
+        return list(parse_shell_to_asts(script))
+
+    def top_level():
+        return [node for node, _, _, _ in parsed()]
+
+    return {
+        "parse": (lambda: script, lambda path: list(parse_shell_to_asts(path))),
+        "parse_interned": (lambda: script, lambda path: list(parse_shell_to_asts(path, interner=Interner(compact=True)))),
+        "iter_ast": (parsed, lambda ast: sum(1 for _ in iter_ast(ast))),
+        "walk_visit": (parsed, lambda ast: walk_ast(ast, visit=lambda node: None)),
+        "walk_replace": (parsed, lambda ast: walk_ast(ast, replace=lambda node: None)),
+        "is_effect_free": (top_level, lambda nodes: sum(map(is_effect_free, nodes))),
+        "effect_analysis": (top_level, lambda nodes: sum(map(EffectAnalysis(), nodes))),
+        "ast_to_code": (top_level, ast_to_code),
+        "replace_with_cat": (parsed, replacing(replace_with_cat, tmp)),
+        "replace_with_debug_jit": (parsed, replacing(replace_with_debug_jit, tmp)),
+        "replace_with_jit": (parsed, replacing(replace_with_jit, tmp)),
+        "stream_try_unsafe": (
+            lambda: script,
+            lambda path: stream_try_unsafe(path, os.path.join(tmp, "stream.safe"), os.path.join(tmp, "stream.stubs")),
+        ),
+    }
+
+
+def measure(setup, benchmark, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        argument = setup()
+        gc.collect()
+        start = time.perf_counter()
+        benchmark(argument)
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "times": times}
+
+
+def current_commit() -> dict:
+    def git(*args) -> str | None:
+        try:
+            return subprocess.run(
+                ["git", *args], cwd=BENCH_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(status) if status is not None else None}
+
+
+def compare(old: dict, new: dict, threshold: float) -> list[str]:
+    """
+    Prints how each benchmark in both runs changed, and returns the ones
+    that got slower than `threshold` times the old run's best.
+    """
+    if old.get("script") != new.get("script"):
+        print("warning: the runs are on different scripts", file=sys.stderr)
+    print(f"comparing with {old.get('commit') or 'unknown commit'} ({old.get('date')})")
+    print(f"{'':<24} {'old':>10} {'new':>10} {'change':>8}")
+    regressed = []
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        before, after = old["results"][name]["best"], result["best"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > threshold:
+            regressed.append(name)
+            flag = "  <- slower"
+        print(f"{name:<24} {before * 1e3:8.1f}ms {after * 1e3:8.1f}ms {ratio:7.2f}x{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the pipeline")
+    parser.add_argument("--commands", type=int, default=2000, help="Top-level commands in the synthetic script")
+    parser.add_argument("--depth", type=int, default=2, help="How deep its compound commands nest")
+    parser.add_argument("--mix", default="", help="Feature weights, e.g. `pipeline=4,heredoc=0`")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument("--only", default="", help="Comma-separated benchmarks to run (default: all)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="Compare with earlier results (on the same script)")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown (new/old) that counts as a regression")
+    args = parser.parse_args()
+
+    old = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as old_file:
+            old = json.load(old_file)
+        # rerun exactly what was saved, unless told otherwise
+        for key in ("commands", "depth", "seed"):
+            if parser.get_default(key) == getattr(args, key):
+                setattr(args, key, old["script"][key])
+        if not args.mix:
+            args.mix = ",".join(f"{feature}={weight}" for feature, weight in old["script"]["mix"].items())
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    # time the work, not the cache
+    utils.PARSE_CACHE_DIR = ""
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "synthetic.sh")
+        with open(script, "w", encoding="utf-8") as out_file:
+            out_file.write(generate(args.commands, args.depth, mix, args.seed))
+
+        suite = benchmarks(script, tmp)
+        only = [name for name in args.only.split(",") if name]
+        for name in only:
+            if name not in suite:
+                parser.error(f"unknown benchmark {name!r} (known: {', '.join(suite)})")
+
+        run = {
+            **current_commit(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "script": {
+                "commands": args.commands,
+                "depth": args.depth,
+                "mix": mix,
+                "seed": args.seed,
+                "bytes": os.path.getsize(script),
+            },
+            "repeat": args.repeat,
+            "results": {},
+        }
+        print(f"{args.commands} commands, depth {args.depth}, {run['script']['bytes'] / 2**10:.0f} KiB script")
+        print(f"{'':<24} {'best':>10} {'median':>10}")
+        for name, (setup, benchmark) in suite.items():
+            if only and name not in only:
+                continue
+            result = run["results"][name] = measure(setup, benchmark, args.repeat)
+            print(f"{name:<24} {result['best'] * 1e3:8.1f}ms {result['median'] * 1e3:8.1f}ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as out_file:
+            json.dump(run, out_file, indent=2)
+            print(file=out_file)
+
+    if old is not None:
+        print()
+        regressed = compare(old, run, args.threshold)
+        if regressed:
+            print(f"{len(regressed)} slower than {args.threshold}x: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
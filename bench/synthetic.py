@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+##
+## Generates synthetic shell scripts to benchmark on: a number of top-level
+## commands, nested up to some depth, drawn from a weighted mix of shell
+## features. The same arguments (and seed) always give the same script.
+##
+## Usage:
+##
+##   python3 bench/synthetic.py --commands 5000 --depth 3 --mix pipeline=4,heredoc=0 -o big.sh
+##
+
+import argparse
+import random
+import sys
+
+# how often each feature is picked, relative to the others
+DEFAULT_MIX = {
+    "command": 6,
+    "assignment": 2,
+    "pipeline": 3,
+    "substitution": 2,
+    "heredoc": 1,
+    "if": 2,
+    "for": 1,
+    "while": 1,
+    "case": 1,
+    "function": 1,
+}
+
+# features with commands inside them, which only go as deep as `depth`
+COMPOUND = {"if", "for", "while", "case", "function"}
+
+PROGRAMS = ["echo", "printf", "grep", "sed", "cut", "sort", "uniq", "wc", "cat", "tr", "head", "tail", "rm", "cp"]
+FLAGS = ["-n", "-v", "-rf", "-c", "-u", "-l", "-e", "-s"]
+VARIABLES = ["x", "i", "f", "out", "input", "name", "count", "dir"]
+
+
+def parse_mix(text: str) -> dict[str, int]:
+    """
+    `DEFAULT_MIX`, with the weights in `text` (`feature=weight,...`) replaced.
+    """
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, text.split(",")):
+        feature, _, weight = item.partition("=")
+        if feature not in mix:
+            raise ValueError(f"unknown feature {feature!r} (known: {', '.join(mix)})")
+        mix[feature] = int(weight)
+    return mix
+
+
+class ScriptGenerator:
+    def __init__(self, mix: dict[str, int] | None = None, depth: int = 2, seed: int = 0):
+        self.mix = mix or dict(DEFAULT_MIX)
+        self.depth = depth
+        self.random = random.Random(seed)
+        self.functions = 0
+
+    def script(self, commands: int) -> str:
+        return "".join(self.command(self.depth, "") for _ in range(commands))
+
+    def command(self, depth: int, indent: str) -> str:
+        features = [f for f, weight in self.mix.items() if weight > 0 and (depth > 0 or f not in COMPOUND)]
+        if not features:
+            return self.simple(indent)
+        feature = self.random.choices(features, [self.mix[f] for f in features])[0]
+        return getattr(self, f"make_{feature}")(depth, indent)
+
+    def body(self, depth: int, indent: str) -> str:
+        return "".join(self.command(depth - 1, indent + "  ") for _ in range(self.random.randint(1, 3)))
+
+    def word(self) -> str:
+        var = self.random.choice(VARIABLES)
+        match self.random.randrange(6):
+            case 0:
+                return f'"${var}"'
+            case 1:
+                return f'"${{{var}:-default}}"'
+            case 2:
+                return self.random.choice(FLAGS)
+            case 3:
+                return f'"{var}: ${var}"'
+            case 4:
+                return f"/tmp/{var}.txt"
+            case _:
+                return self.random.choice(["hello", "world", "some_file", "*.sh", "a-z", "A-Z"])
+
+    def simple_text(self) -> str:
+        words = [self.random.choice(PROGRAMS)] + [self.word() for _ in range(self.random.randint(1, 4))]
+        if self.random.random() < 0.2:
+            words.append(f'>>"${self.random.choice(VARIABLES)}"')
+        return " ".join(words)
+
+    def simple(self, indent: str) -> str:
+        return f"{indent}{self.simple_text()}\n"
+
+    def make_command(self, depth: int, indent: str) -> str:
+        return self.simple(indent)
+
+    def make_assignment(self, depth: int, indent: str) -> str:
+        return f"{indent}{self.random.choice(VARIABLES)}={self.word()}\n"
+
+    def make_pipeline(self, depth: int, indent: str) -> str:
+        return indent + " | ".join(self.simple_text() for _ in range(self.random.randint(2, 4))) + "\n"
+
+    def make_substitution(self, depth: int, indent: str) -> str:
+        var = self.random.choice(VARIABLES)
+        if self.random.random() < 0.5:
+            return f'{indent}{var}=$(basename "${var}" .sh)\n'
+        return f'{indent}echo "now: $(date +%s)" "$({self.simple_text()})"\n'
+
+    def make_heredoc(self, depth: int, indent: str) -> str:
+        # the body and terminator can't be indented
+        lines = [f"line {n}: {self.word()} ${self.random.choice(VARIABLES)}" for n in range(self.random.randint(3, 10))]
+        return f"{indent}cat <<EOF\n" + "\n".join(lines) + "\nEOF\n"
+
+    def make_if(self, depth: int, indent: str) -> str:
+        test = f'[ "${self.random.choice(VARIABLES)}" = {self.random.choice(["yes", "no", "1"])} ]'
+        text = f"{indent}if {test}; then\n{self.body(depth, indent)}"
+        if self.random.random() < 0.5:
+            text += f"{indent}else\n{self.body(depth, indent)}"
+        return text + f"{indent}fi\n"
+
+    def make_for(self, depth: int, indent: str) -> str:
+        var = self.random.choice(VARIABLES)
+        items = " ".join(self.random.choice(["a", "b", "c", "*.txt", "$input"]) for _ in range(3))
+        return f"{indent}for {var} in {items}; do\n{self.body(depth, indent)}{indent}done\n"
+
+    def make_while(self, depth: int, indent: str) -> str:
+        return f'{indent}while read -r line; do\n{self.body(depth, indent)}{indent}done <"$input"\n'
+
+    def make_case(self, depth: int, indent: str) -> str:
+        arms = "".join(
+            f"{indent}  {pattern})\n{self.body(depth, indent + '  ')}{indent}    ;;\n"
+            for pattern in ("start", "stop|halt", "*")
+        )
+        return f'{indent}case "$1" in\n{arms}{indent}esac\n'
+
+    def make_function(self, depth: int, indent: str) -> str:
+        self.functions += 1
+        return f"{indent}helper_{self.functions}() {{\n{self.body(depth, indent)}{indent}}}\n"
+
+
+def generate(commands: int, depth: int = 2, mix: dict[str, int] | None = None, seed: int = 0) -> str:
+    """
+    A script of `commands` top-level commands, nested at most `depth` deep.
+    """
+    return ScriptGenerator(mix, depth, seed).script(commands)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic shell script")
+    parser.add_argument("--commands", type=int, default=1000, help="Number of top-level commands")
+    parser.add_argument("--depth", type=int, default=2, help="How deep compound commands nest")
+    parser.add_argument("--mix", default="", help=f"Feature weights, e.g. `pipeline=4,heredoc=0` (features: {', '.join(DEFAULT_MIX)})")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", "-o", default="-", help="Where to write the script (`-` for stdout)")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as exc:
+        parser.error(str(exc))
+    script = generate(args.commands, args.depth, mix, args.seed)
+    if args.output == "-":
+        sys.stdout.write(script)
+    else:
+        with open(args.output, "w", encoding="utf-8") as out_file:
+            out_file.write(script)
+
+
+if __name__ == "__main__":
+    main()
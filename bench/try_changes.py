@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+##
+## Builds a fake `try` sandbox whose upper directory changes a tree of N files
+## (modifying, adding and deleting files, and adding directories), and times
+## `try summary` on it with `try-changes` and with the shell's
+## `find_upperdir_changes` and `process_changes`, after checking that both
+## report the same changes, in the same order.
+##
+## Deletions are overlayfs whiteouts (0/0 character devices), so making them
+## takes `mknod` privileges; opaque directories are only checked if
+## `getfattr` is installed (the shell needs it to see them).
+##
+## Usage: python3 bench/try_changes.py [--files N] [--no-shell]
+##
+
+import argparse
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+BIN = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+TRY = os.path.join(BIN, "try")
+
+FILES_PER_DIR = 100
+
+
+def make_sandbox(tmp: str, files: int) -> str:
+    """
+    A host tree and a sandbox changing it: of every four files, one is
+    modified, one added, one deleted, and one added in a new directory.
+    """
+    host = os.path.join(tmp, "host")
+    sandbox = os.path.join(tmp, "sandbox")
+    upper = os.path.join(sandbox, "upperdir") + host
+    opaque = shutil.which("getfattr") is not None
+
+    for d in range(0, files, FILES_PER_DIR):
+        host_dir, upper_dir = os.path.join(host, f"d{d}"), os.path.join(upper, f"d{d}")
+        os.makedirs(host_dir)
+        os.makedirs(upper_dir)
+        for i in range(d, min(d + FILES_PER_DIR, files)):
+            name = f"f{i}"
+            match i % 4:
+                case 0:
+                    open(os.path.join(host_dir, name), "w").close()
+                    with open(os.path.join(upper_dir, name), "w") as out_file:
+                        out_file.write("modified\n")
+                case 1:
+                    open(os.path.join(upper_dir, name), "w").close()
+                case 2:
+                    open(os.path.join(host_dir, name), "w").close()
+                    os.mknod(os.path.join(upper_dir, name), stat.S_IFCHR | 0o600, 0)
+                case 3:
+                    new_dir = os.path.join(upper_dir, f"new{i // 16}")
+                    os.makedirs(new_dir, exist_ok=True)
+                    open(os.path.join(new_dir, name), "w").close()
+        if opaque and d % (10 * FILES_PER_DIR) == 0:
+            # a directory replaced by one of the same name
+            os.makedirs(os.path.join(host_dir, "replaced"))
+            os.makedirs(os.path.join(upper_dir, "replaced"))
+            os.setxattr(os.path.join(upper_dir, "replaced"), "user.overlay.opaque", b"y")
+
+    for name in ("workdir", "temproot"):
+        os.makedirs(os.path.join(sandbox, name))
+    return sandbox
+
+
+def summary(sandbox: str, scanner: bool) -> tuple[float, str]:
+    path = os.environ.get("PATH", "").split(os.pathsep)
+    path = [d for d in path if d and os.path.abspath(d) != BIN]
+    if scanner:
+        path.insert(0, BIN)
+    env = {**os.environ, "PATH": os.pathsep.join(path)}
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [TRY, "summary", sandbox], stdin=subprocess.DEVNULL, capture_output=True, text=True, env=env
+    )
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(f"try summary failed:\n{result.stderr}")
+    return seconds, result.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scanning a try sandbox for changes")
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--no-shell", action="store_true", help="Only time try-changes (the shell takes minutes)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        try:
+            sandbox = make_sandbox(tmp, args.files)
+        except PermissionError as exc:
+            sys.exit(f"could not make a whiteout ({exc}): needs mknod privileges")
+        print(f"{args.files} files: sandbox made in {time.perf_counter() - start:.1f}s")
+
+        fast, fast_output = summary(sandbox, scanner=True)
+        changes = fast_output.count("\n") - 3
+        print(f"{'try-changes':<12} {fast:8.2f}s  ({changes} changes)")
+
+        if not args.no_shell:
+            slow, slow_output = summary(sandbox, scanner=False)
+            assert fast_output == slow_output, "try-changes and the shell disagree"
+            print(f"{'shell':<12} {slow:8.2f}s  (identical, {slow / fast:.0f}x slower)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+##
+## Times running commands under `try` one sandbox per command (what a
+## transformed script does by default) against sharing one `try session`, and
+## checks the session's commit and rollback points: after a rollback none of
+## the commands' changes reach the host, and after a commit all of them do.
+##
+## Needs `unshare` and mount privileges, like `try` itself.
+##
+## Usage: python3 bench/try_session.py [--commands N]
+##
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "try")
+
+
+def run_try(args: list[str], env: dict) -> str:
+    result = subprocess.run(
+        [TRY, *args], stdin=subprocess.DEVNULL, capture_output=True, text=True, env=env
+    )
+    if result.returncode != 0:
+        sys.exit(f"try {' '.join(args)} failed:\n{result.stderr}")
+    return result.stdout.strip()
+
+
+def remove_sandbox(path: str):
+    # overlayfs leaves directories in the workdir that nobody can look into
+    subprocess.run(["chmod", "-R", "u+rwx", path], stderr=subprocess.DEVNULL)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def timed(commands: list[str], args: list[str], env: dict) -> list[float]:
+    """
+    Runs each command with `try ARGS`, returning how long each took.
+    """
+    times = []
+    for command in commands:
+        start = time.perf_counter()
+        sandbox = run_try([*args, command], env)
+        times.append(time.perf_counter() - start)
+        if sandbox:
+            # `-n` shows the sandbox it made
+            remove_sandbox(sandbox)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark try sessions")
+    parser.add_argument("--commands", type=int, default=20)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.pop("TRY_SESSION", None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [os.path.join(tmp, f"file{i}") for i in range(args.commands)]
+        for path in files:
+            open(path, "w").close()
+        commands = [f"rm {path}" for path in files]
+
+        fresh = timed(commands, ["-n"], env)
+
+        start = time.perf_counter()
+        session = run_try(["session", "start"], env)
+        setup = time.perf_counter() - start
+        try:
+            session_env = {**env, "TRY_SESSION": session}
+            shared = timed(commands, [], session_env)
+
+            run_try(["session", "rollback"], session_env)
+            assert all(os.path.exists(path) for path in files), "changes leaked before a commit"
+            timed(commands, [], session_env)
+            run_try(["-y", "session", "commit"], session_env)
+            assert not any(os.path.exists(path) for path in files), "the commit lost changes"
+        finally:
+            run_try(["session", "end"], session_env)
+
+    print(f"{args.commands} commands")
+    print(f"{'':<20} {'median':>10} {'total':>10}")
+    print(f"{'sandbox each':<20} {statistics.median(fresh) * 1e3:8.1f}ms {sum(fresh) * 1e3:8.1f}ms")
+    print(f"{'session':<20} {statistics.median(shared) * 1e3:8.1f}ms {(sum(shared) + setup) * 1e3:8.1f}ms"
+          f"  (start: {setup * 1e3:.1f}ms)")
+    print("rollback and commit: ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+##
+## Times `walk_ast` (and the read-only `iter_ast`) on a large script, and
+## measures how much memory a walk that doesn't replace anything allocates.
+##
+## The script is a single `if` whose body is a long `;` chain, followed by the
+## same commands at the top level, so it also checks that deep trees don't
+## hit the recursion limit. It also checks that the per-class traversal
+## functions generated from `AST_CHILD_FIELDS` agree with `ast_children` and
+## `rebuild_ast_node`, and times a walk through those instead.
+##
+## Usage: python3 bench/walk.py [--commands N] [--repeat N]
+##
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SOLUTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SOLUTION")
+sys.path.insert(0, SOLUTION_DIR)
+
+import utils
+from utils import *  # type: ignore
+
+COMMANDS = [
+    'echo "Number: $i" >>"$out"',
+    "cat /tmp/in | tr a-z A-Z | sort -u",
+    'x=$(basename "$f" .sh)',
+    "rm -rf /tmp/build",
+    'grep -c "${pattern:-foo}" "$@" 2>/dev/null',
+]
+
+
+def large_script(commands: int) -> str:
+    body = [COMMANDS[i % len(COMMANDS)] for i in range(commands)]
+    return "if true; then\n" + "\n".join(body) + "\nfi\n" + "\n".join(body) + "\n"
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark walk_ast on a large script")
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # libdash's own AST conversion recurses on `;` chains, but the walk shouldn't
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 20 * args.commands))
+    with tempfile.NamedTemporaryFile("w", suffix=".sh") as script:
+        script.write(large_script(args.commands))
+        script.flush()
+        ast = list(parse_shell_to_asts(script.name))
+    sys.setrecursionlimit(recursion_limit)
+
+    def replace_rm(node):
+        match node:
+            case AST.CommandNode() if node.arguments and AST.string_of_arg(node.arguments[0]) == "rm":
+                return AST.CommandNode(
+                    line_number=node.line_number,
+                    assignments=node.assignments,
+                    arguments=[string_to_argchars("echo")] + node.arguments,
+                    redir_list=node.redir_list,
+                )
+            case _:
+                return None
+
+    for node, _, _ in iter_ast(ast):
+        children = ast_children(node)
+        fast = AST_CHILDREN[type(node)](node)
+        assert len(fast) == len(children) and all(a is b for a, b in zip(fast, children)), (
+            f"the children of a {type(node).__name__} disagree"
+        )
+        rebuilt, fast = rebuild_ast_node(node, children), AST_REBUILDERS[type(node)](node, children)
+        assert type(rebuilt) is type(fast) and (
+            vars(rebuilt) == vars(fast) if hasattr(rebuilt, "__dict__") else rebuilt == fast
+        ), f"rebuilding a {type(node).__name__} disagrees"
+
+    print(f"{2 * args.commands} commands, {len(ast)} top-level")
+    for name, kwargs in [
+        ("visit", {"visit": lambda node: None}),
+        ("replace nothing", {"replace": lambda node: None}),
+        ("replace rm", {"replace": replace_rm}),
+        ("replace rm (per class)", {"replace": {AST.CommandNode: replace_rm}}),
+    ]:
+        elapsed = best_of(args.repeat, lambda: walk_ast(ast, **kwargs))
+        print(f"{name:<24} {elapsed * 1e3:10.1f} ms")
+
+    fast_path = utils.AST_CHILDREN, utils.AST_REBUILDERS
+    utils.AST_CHILDREN, utils.AST_REBUILDERS = TypeTable(default=ast_children), TypeTable(default=rebuild_ast_node)
+    try:
+        elapsed = best_of(args.repeat, lambda: walk_ast(ast, replace=lambda node: None))
+    finally:
+        utils.AST_CHILDREN, utils.AST_REBUILDERS = fast_path
+    print(f"{'(without the fast path)':<24} {elapsed * 1e3:10.1f} ms")
+
+    def iterate():
+        for _ in iter_ast(ast):
+            pass
+
+    elapsed = best_of(args.repeat, iterate)
+    print(f"{'iter_ast':<24} {elapsed * 1e3:10.1f} ms")
+
+    # the first `$(...)` is a few commands in, but there are no functions at all
+    nodes = [node for node, _, _, _ in ast]
+    for cls in [AST.BArgChar, AST.DefunNode]:
+        elapsed = best_of(args.repeat, lambda: contains_node(nodes, cls))
+        print(f"{'contains ' + cls.__name__:<24} {elapsed * 1e3:10.1f} ms")
+
+    for name, fn in [
+        ("replace nothing", lambda: walk_ast(ast, replace=lambda node: None)),
+        ("iter_ast", iterate),
+    ]:
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'peak allocated':<24} {peak / 2**10:10.1f} KiB ({name})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+##
+## Runs step 8 over many scripts at once, in parallel.
+##
+## Each script is transformed in a worker process (with libdash initialized
+## once per worker) and gets its own directory under OUT_DIR, named after a
+## hash of the script's absolute path, holding:
+##
+##   - `NAME.safe`, the transformed script
+##   - `NAME.jit_stubs`, its stub bundle
+##
+## Every script is reported as it finishes, with how long it took; a script
+## that fails to parse (or crashes libdash) is reported and doesn't stop the
+## others.
+##
+## Usage:
+##
+##   python3 src/batch.py OUT_DIR scripts/ more.sh ...
+##   find corpus -name '*.sh' | python3 src/batch.py OUT_DIR --from -
+##
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+import os
+import sys
+import time
+
+from utils import *  # type: ignore
+from solution import stream_try_unsafe
+
+
+def find_scripts(paths: list[str]) -> list[str]:
+    """
+    The scripts in `paths`: files are taken as they are, and directories are
+    searched (recursively) for `*.sh` files.
+    """
+    scripts = []
+    for path in paths:
+        if not os.path.isdir(path):
+            scripts.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            scripts.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(".sh"))
+    return scripts
+
+
+def script_namespace(out_dir: str, script: str) -> str:
+    digest = hashlib.sha256(os.path.abspath(script).encode("utf-8")).hexdigest()
+    return os.path.join(os.path.abspath(out_dir), digest[:16])
+
+
+def transform_script(script: str, out_dir: str) -> dict:
+    """
+    Runs step 8 on `script` (in a worker).
+
+    :return: A report: the script, whether it worked (and the error if
+             not), how long it took, how many commands it has, and where its
+             output went
+    """
+    namespace = script_namespace(out_dir, script)
+    name = os.path.basename(script)
+    report = {"script": script, "ok": False, "seconds": 0.0, "commands": 0, "output": None, "error": None}
+
+    start = time.perf_counter()
+    try:
+        # libdash exits the whole process on a file it can't open
+        with open(script, "rb"):
+            pass
+        # its stub bundle is pickles that `expand.py` loads, so the directory is private
+        os.makedirs(namespace, mode=0o700, exist_ok=True)
+        output = os.path.join(namespace, f"{name}.safe")
+        report["commands"] = stream_try_unsafe(script, output, os.path.join(namespace, f"{name}.jit_stubs"))
+        report["ok"] = True
+        report["output"] = output
+    except Exception as exc:
+        report["error"] = f"{type(exc).__name__}: {exc}"
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def run_batch(scripts: list[str], out_dir: str, jobs: int):
+    """
+    Transforms `scripts` over a pool of `jobs` workers, yielding a report for
+    each as it finishes.
+    """
+    with ProcessPoolExecutor(jobs, initializer=initialize_libdash) as pool:
+        futures = {pool.submit(transform_script, script, out_dir): script for script in scripts}
+        crashed = []
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                crashed.append(futures[future])
+
+    # a worker died (taking the pool with it), and we can't tell on which
+    # script, so give each one we lost a worker of its own
+    for script in crashed:
+        with ProcessPoolExecutor(1, initializer=initialize_libdash) as pool:
+            try:
+                yield pool.submit(transform_script, script, out_dir).result()
+            except BrokenProcessPool:
+                yield {"script": script, "ok": False, "seconds": 0.0, "commands": 0, "output": None,
+                       "error": "the worker died"}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transform many shell scripts (step 8) in parallel"
+    )
+    parser.add_argument("out_dir", help="Directory to hold the transformed scripts and their stubs")
+    parser.add_argument("paths", nargs="*", help="Scripts, or directories to search for `*.sh` files")
+    parser.add_argument("--from", dest="from_file", help="Read more paths, one per line, from this file (`-` for stdin)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--report", help="Write a JSON report line per script to this file")
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    if args.from_file == "-":
+        paths.extend(line.rstrip("\n") for line in sys.stdin if line.strip())
+    elif args.from_file:
+        with open(args.from_file, encoding="utf-8") as lines:
+            paths.extend(line.rstrip("\n") for line in lines if line.strip())
+    scripts = find_scripts(paths)
+
+    start = time.perf_counter()
+    reports = []
+    with open_output(args.report or os.devnull) as report_file:
+        for report in run_batch(scripts, args.out_dir, args.jobs):
+            reports.append(report)
+            print(json.dumps(report), file=report_file)
+            if report["ok"]:
+                print(f"ok   {report['seconds']:8.3f}s {report['script']} -> {report['output']}")
+            else:
+                print(f"FAIL {report['seconds']:8.3f}s {report['script']}: {report['error']}")
+    elapsed = time.perf_counter() - start
+
+    failed = sum(not report["ok"] for report in reports)
+    busy = sum(report["seconds"] for report in reports)
+    print(
+        f"{len(reports) - failed} transformed, {failed} failed, in {elapsed:.2f}s "
+        f"({len(reports) / elapsed if elapsed else 0:.1f} scripts/s, {busy:.2f}s in workers, {args.jobs} jobs)"
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,21 @@
 __input="$JIT_INPUT"
 unset __cmd_status
 
-if [ -z "$__input" ] || [ ! -f "$__input" ]; then
-  echo "debug_jit.sh: missing input script" >&2
+if [ -z "$__input" ] || [ ! -f "$__input" ] || [ -z "$JIT_STUB" ]; then
+  echo "debug_jit.sh: missing input bundle or stub" >&2
   exit 2
 fi
 
+# pull the stub's text out of the bundle (see `StubBundle` in utils.py)
+__stub=$(tail -c +"$((JIT_STUB + 1))" "$__input" | { read -r __len; head -c "$__len"; })
+
 # debug line
-printf "+ " >&2
-cat "$__input" >&2
+printf "+ %s\n" "$__stub" >&2
 
 # actually run line
-. "$__input"
+eval "$__stub"
 
 # preserve exit status, hide vars
 __cmd_status=$?
-unset __input JIT_INPUT
+unset __input __stub JIT_INPUT JIT_STUB
 (exit "$__cmd_status")
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+##
+## A long-lived JIT expansion server.
+##
+## Running `expand.py` once per stubbed command means paying for Python
+## startup, importing `libdash`/`shasta`/`sh_expand`, and initializing libdash
+## on _every_ command. The server pays those costs once and keeps parsed stubs
+## around, so `jit.sh` only has to hand it a request and wait for the answer.
+##
+## The server lives in a directory (`$JIT_SERVER`) holding:
+##
+##   - `requests`, a FIFO that clients write one request line to
+##   - `pid`, the process id of the server (so clients can tell it's alive)
+##
+## A request is a single tab-separated line:
+##
+##   BUNDLE <TAB> STUB_ID <TAB> BASH_VERSION <TAB> ENV_PATH <TAB> EXPANDED_PATH <TAB> REPLY_FIFO
+##
+## The server expands the stub (using the state saved in `ENV_PATH`), writes the
+## result to `EXPANDED_PATH`, and then writes a status line (`0` on success) to
+## `REPLY_FIFO`. Lines shorter than `PIPE_BUF` are written atomically, so
+## several scripts can share one server.
+## A client waiting on its reply keeps checking that the server is alive, and
+## expands the stub itself if it isn't, so killing the server loses no work.
+##
+## Expanded stubs are remembered in an `ExpansionCache`, so a stub in a loop
+## whose variables don't change is only expanded once.
+##
+## With `JIT_TRACE` set, every request is traced (see "Tracing" in `utils.py`),
+## on a track of its own thread.
+##
+## Usage:
+##
+##   python3 src/expand_server.py /tmp/jit_server &
+##   JIT_SERVER=/tmp/jit_server bash script.sh.safe
+##
+
+import argparse
+from copy import deepcopy
+import os
+import signal
+import sys
+import threading
+import traceback
+
+from utils import *  # type: ignore
+from expand import ExpansionCache, expand_stub, load_variables
+
+
+class StubCache:
+    """
+    Loaded stubs, keyed by bundle and stub id, and invalidated when the bundle
+    changes.
+    """
+
+    def __init__(self):
+        self.stubs = {}
+
+    def get(self, bundle_path: str, stub_id: int) -> tuple[tuple, Stub]:
+        """
+        :return: A key identifying this version of the stub, and the stub
+                 itself (which must not be mutated)
+        """
+        st = os.stat(bundle_path)
+        version = (st.st_mtime_ns, st.st_size)
+
+        cached = self.stubs.get((bundle_path, stub_id))
+        if cached is None or cached[0] != version:
+            cached = (version, read_stub(bundle_path, stub_id))
+            self.stubs[(bundle_path, stub_id)] = cached
+
+        return (bundle_path, stub_id, version), cached[1]
+
+
+def handle_request(line: str, stubs: StubCache, expansions: ExpansionCache):
+    try:
+        bundle_path, stub_id, bash_version, env_path, expanded_path, reply_path = line.split("\t")
+    except ValueError:
+        print(f"expand_server: malformed request {line!r}", file=sys.stderr)
+        return
+
+    status = 0
+    try:
+        with trace_span("request", stub=int(stub_id)) as span:
+            with trace_span("load_stub"):
+                stub_key, stub = stubs.get(bundle_path, int(stub_id))
+            span["line"] = stub.line_number
+            variables = load_variables(env_path, bash_version)
+
+            key = expansions.key(stub_key, stub, variables)
+            expanded = expansions.get(key) if key is not None else None
+            span["cached"] = expanded is not None
+            if expanded is None:
+                # expansion mutates the AST, so work on a copy
+                expanded = expand_stub(stub_to_parsed(deepcopy(stub)), variables)
+                if key is not None:
+                    expansions.put(key, expanded)
+
+            with open(expanded_path, "w", encoding="utf-8") as out_file:
+                print(expanded, file=out_file)
+    except Exception:
+        # the client will fall back to running `expand.py` itself
+        traceback.print_exc()
+        status = 1
+
+    with open(reply_path, "w", encoding="utf-8") as reply:
+        print(status, file=reply)
+
+
+def serve(server_dir: str, cache_size: int):
+    os.makedirs(server_dir, exist_ok=True)
+    requests_path = os.path.join(server_dir, "requests")
+    pid_path = os.path.join(server_dir, "pid")
+
+    if not os.path.exists(requests_path):
+        os.mkfifo(requests_path)
+    with open(pid_path, "w", encoding="utf-8") as pid_file:
+        print(os.getpid(), file=pid_file)
+
+    stubs = StubCache()
+    expansions = ExpansionCache(cache_size)
+
+    def shutdown(signum, frame):
+        print(f"expand_server: {expansions}", file=sys.stderr)
+        for path in (pid_path, requests_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # opening read-write means we never see EOF when a client hangs up
+    fd = os.open(requests_path, os.O_RDWR)
+    with os.fdopen(fd, "r", encoding="utf-8") as requests:
+        for line in requests:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            threading.Thread(
+                target=handle_request, args=(line, stubs, expansions), daemon=True
+            ).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve JIT expansion requests from `jit.sh`"
+    )
+    parser.add_argument("server_dir", help="Directory to hold the request FIFO and pid file")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=4096,
+        help="Maximum number of expanded stubs to remember",
+    )
+    args = parser.parse_args()
+
+    serve(args.server_dir, args.cache_size)
+
+
+if __name__ == "__main__":
+    main()
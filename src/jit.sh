@@ -6,41 +6,149 @@
 # Save the shell state
 
 __input="$JIT_INPUT"
+__stub="$JIT_STUB"
+__loop="$JIT_LOOP"
 unset __cmd_status
 
-if [ -z "$__input" ] || [ ! -f "$__input" ]; then
-  echo "jit.sh: missing input script" >&2
+if [ -z "$__input" ] || [ ! -f "$__input" ] || [ -z "$__stub" ]; then
+  echo "jit.sh: missing input bundle or stub" >&2
   exit 2
 fi
 
-# make JIT_POS variables to capture positional variables
-JIT_POS_0="$0"
-__idx=1
-for __arg in "$@"; do
-  eval "JIT_POS_${__idx}=\"\$__arg\""
-  __idx=$((__idx + 1))
-done
+# with JIT_TRACE=FILE, append a Chrome trace event per phase to FILE (see
+# "Tracing" in utils.py); `expand.py` adds its own, inside our "expand" span
+if [ -n "$JIT_TRACE" ] && [ -z "$EPOCHREALTIME" ]; then
+  echo "jit.sh: JIT_TRACE needs bash 5 (for EPOCHREALTIME)" >&2
+  unset JIT_TRACE
+fi
+if [ -n "$JIT_TRACE" ]; then
+  # __jit_trace B|E NAME: a span begins or ends now
+  # __jit_trace X NAME START: a span from START until now
+  #
+  # (begin/end pairs need no state of their own, so they survive the stub
+  # running a function with stubs of its own; for the same reason, this stays defined)
+  __jit_trace() {
+    local now="${EPOCHREALTIME/[.,]/}"
+    local event="\"name\":\"$2\",\"cat\":\"jit\",\"pid\":$BASHPID,\"tid\":$BASHPID"
+    case "$1" in
+      B) event="{$event,\"ph\":\"B\",\"ts\":$now,\"args\":{\"stub\":$__stub}}" ;;
+      E) event="{$event,\"ph\":\"E\",\"ts\":$now}" ;;
+      X) event="{$event,\"ph\":\"X\",\"ts\":$3,\"dur\":$((now - $3)),\"args\":{\"stub\":$__stub}}" ;;
+    esac
+    [ -s "$JIT_TRACE" ] || event="[
+$event"
+    printf '%s,\n' "$event" >>"$JIT_TRACE"
+  }
+  __jit_trace B jit
+  __trace_start="${EPOCHREALTIME/[.,]/}"
+fi
 
-# save all current variables
-__saved_env="$JIT_INPUT".env
-declare -p >"$__saved_env"
+# our scratch files: the same stub can run in several places at once (the
+# bundle shares identical commands, and a stub can run in the background), so
+# they're this shell's own
+__scratch="$__input.$__stub.$BASHPID"
+
+# a stub hoisted out of a loop (`JIT_LOOP`, see "Hoisting" in solution.py) is
+# expanded once per run of the loop: `jit_loop.sh` gave the run a token, and
+# we reuse an expansion made under it (without even saving the state)
+__expanded="$__scratch".expanded
+__token=
+__reuse=
+if [ -n "$__loop" ]; then
+  __token="__jit_loop_$__loop"
+  __token="${!__token}"
+  if [ -n "$__token" ] && [ -f "$__expanded.loop" ] &&
+     read -r __expanded_in <"$__expanded.loop" && [ "$__expanded_in" = "$__token" ]
+  then
+    __reuse=1
+  fi
+fi
+
+if [ -z "$__reuse" ]; then
+  # make JIT_POS variables to capture positional variables
+  JIT_POS_0="$0"
+  __idx=1
+  for __arg in "$@"; do
+    eval "JIT_POS_${__idx}=\"\$__arg\""
+    __idx=$((__idx + 1))
+  done
+
+  # save the variables the stub reads (`JIT_VARS`, when the preprocessor could
+  # tell), or else all current variables
+  __saved_env="$__scratch".env
+  if [ -n "${JIT_VARS+set}" ]; then
+    eval "declare -p IFS $JIT_VARS \"\${!JIT_POS_@}\"" >"$__saved_env" 2>/dev/null
+  else
+    declare -p >"$__saved_env"
+  fi
+  [ -z "$JIT_TRACE" ] || __jit_trace X "save state" "$__trace_start"
+fi
 
 ####################
 # Actually interpose
 
-# !!! expand the script
-__expanded=$__input".expanded"
-python3 src/expand.py "$__input" "$BASH_VERSION" >"$__expanded"
+# !!! expand the script (into `$__expanded`), unless we're reusing an expansion
+
+if [ -n "$__reuse" ]; then
+  [ -z "$JIT_TRACE" ] || __jit_trace X reuse "$__trace_start"
+else
+  # ask the expansion server (if there is a live one), otherwise run expand.py
+  [ -z "$JIT_TRACE" ] || __trace_start="${EPOCHREALTIME/[.,]/}"
+  __status=1
+  if [ -n "$JIT_SERVER" ] && [ -p "$JIT_SERVER/requests" ] &&
+     read -r __server_pid <"$JIT_SERVER/pid" 2>/dev/null &&
+     kill -0 "$__server_pid" 2>/dev/null
+  then
+    __reply="$__scratch".reply
+    [ -p "$__reply" ] || mkfifo "$__reply"
+    # read-write, so neither open blocks (or sees an EOF) if the server has
+    # gone away since: the request just sits in the pipe
+    exec {__reply_fd}<>"$__reply" {__request_fd}<>"$JIT_SERVER/requests"
+    printf '%s\t%s\t%s\t%s\t%s\t%s\n' "$__input" "$__stub" "$BASH_VERSION" "$__saved_env" "$__expanded" "$__reply" \
+      >&"$__request_fd"
+    exec {__request_fd}>&-
+    # wait for the answer for as long as the server is alive to give it
+    until read -r -t 1 -u "$__reply_fd" __status; do
+      if ! kill -0 "$__server_pid" 2>/dev/null; then
+        __status=1
+        break
+      fi
+    done
+    exec {__reply_fd}>&-
+  fi
+  if [ "$__status" != 0 ]
+  then
+    python3 src/expand.py "$__input" "$__stub" "$BASH_VERSION" "$__saved_env" >"$__expanded"
+    __status=$?
+  fi
+  # remember which run of the loop this expansion is good for
+  if [ -n "$__loop" ] && [ "$__status" = 0 ]; then
+    printf '%s\n' "$__token" >"$__expanded.loop"
+  fi
+  [ -z "$JIT_TRACE" ] || __jit_trace X expand "$__trace_start"
+fi
 
 # !!! run the expanded script
+[ -z "$JIT_TRACE" ] || __jit_trace B source
 . "$__expanded"
 __cmd_status=$?
+[ -z "$JIT_TRACE" ] || { __jit_trace E source; __jit_trace E jit; }
 
 #################################
 # Try to clean up after ourselves
 
 # would be nice to un-export... but not for now
 
+# a subshell's files would pile up (but a hoisted stub's expansion is for the
+# next iteration)
+if [ "$BASHPID" != "$$" ]; then
+  if [ -n "$__loop" ]; then
+    rm -f "$__scratch".env "$__scratch".reply
+  else
+    rm -f "$__scratch".env "$__scratch".reply "$__expanded"
+  fi
+fi
+
 # unset JIT_POS_ positional arguments
 unset JIT_POS_0
 __idx=1
@@ -50,7 +158,8 @@ for __arg in "$@"; do
 done
 
 # hide the evidence
-unset __saved_env __expanded __input __idx __arg
+unset __saved_env __expanded __input __stub __idx __arg __status __server_pid __reply __trace_start
+unset __loop __token __reuse __expanded_in __scratch __reply_fd __request_fd
 
 # exit with the correct status
 (exit "$__cmd_status")
@@ -0,0 +1,28 @@
+#!/bin/bash
+
+# Starts a run of a loop that stubs were hoisted out of (see "Hoisting" in
+# solution.py): `JIT_LOOP=ID JIT_COMMANDS="..." . jit_loop.sh` comes right
+# before the loop.
+#
+# The run gets a fresh token in `__jit_loop_ID`, and `jit.sh` reuses the
+# expansion of a hoisted stub if it was made under it. If one of the commands
+# the loop runs is a function, it could change anything, so the run gets no
+# token, and nothing is reused.
+
+# the loop still sees the status of whatever ran before it
+__jit_status=$?
+
+# unique to this process and this run, even in a subshell of a loop
+__jit_token="$BASHPID.${EPOCHREALTIME:-$RANDOM}.$RANDOM"
+read -r -a __jit_commands <<<"$JIT_COMMANDS"
+for __jit_command in "${__jit_commands[@]}"; do
+  if declare -F "$__jit_command" >/dev/null; then
+    __jit_token=
+    break
+  fi
+done
+eval "__jit_loop_$JIT_LOOP=\$__jit_token"
+
+# hide the evidence, and return the status we found (which `eval` reads before the `unset`)
+unset __jit_token __jit_commands __jit_command
+eval "unset __jit_status; return $__jit_status"